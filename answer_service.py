@@ -1,6 +1,25 @@
+import asyncio
 from retriever import retriever
-from config import SELFHARM_KEYWORDS, ABUSE_KEYWORDS, MAX_DISPLAY_CHARS
-from llm_rephrase import rephrase_answer
+from config import (
+    SAFETY_EMBEDDING, LLM_BYPASS_SCORE, DEFAULT_LLM,
+    RESPONSE_CACHE, RESPONSE_CACHE_THRESHOLD, RESPONSE_CACHE_SIZE,
+    RESPONSE_CACHE_TTL, RESPONSE_CACHE_PATH, LLM_MAX_SEQ_LENGTH, MIN_RETRIEVED_TOKENS,
+    PROMPT_TOKEN_MARGIN,
+)
+from safety import scanner, EmbeddingSafetyClassifier, merge_safety
+from response_cache import SemanticResponseCache, bucket_key
+from text_store import content_hash
+from profiler import profiler
+from startup import Lazy
+from derived_fields import extract_response, clean_display
+from context_budget import ContextBudgeter
+from llm_rephrase import (
+    build_rephrase_prompt, rephrase_answer, stream_rephrase_answer,
+    arephrase_answer, astream_rephrase_answer,
+)
+
+# cached answers are only valid for the prompt template they were generated with
+PROMPT_TEMPLATE_HASH = content_hash(build_rephrase_prompt("{query}", "{retrieved_answer}"))[:12]
 
 
 class AnswerService:
@@ -11,30 +30,155 @@ class AnswerService:
     - Optionally rephrase using an LLM
     """
 
+    def __init__(self, bypass_score: float = LLM_BYPASS_SCORE):
+        self.bypass_score = bypass_score
+        # prototypes are embedded with the retriever's encoder, so scoring
+        # a query reuses the embedding retrieval already computed
+        self.embedding_safety = (
+            EmbeddingSafetyClassifier(retriever.embed_queries) if SAFETY_EMBEDDING else None
+        )
+        self.response_cache = SemanticResponseCache(
+            threshold=RESPONSE_CACHE_THRESHOLD,
+            max_size=RESPONSE_CACHE_SIZE,
+            ttl=RESPONSE_CACHE_TTL,
+            disk_path=RESPONSE_CACHE_PATH,
+        ) if RESPONSE_CACHE else None
+        # sentences of long retrieved answers are ranked against the query embedding
+        self.budgeter = ContextBudgeter(
+            lambda texts: retriever.embedder.encode(
+                list(texts), convert_to_numpy=True, normalize_embeddings=True
+            )
+        )
+
     def safety_check(self, text: str):
-        t = text.lower()
-        if any(k in t for k in SELFHARM_KEYWORDS):
-            return {"level": "high", "reason": "self harm"}
-        if any(k in t for k in ABUSE_KEYWORDS):
-            return {"level": "medium", "reason": "abuse"}
-        return {"level": "ok", "reason": ""}
+        """
+        Single-pass keyword scan over all safety categories.
+        """
+        return scanner.scan(text)
+
+    def query_safety(self, query: str, query_embedding=None):
+        """
+        Keyword scan of the query merged with the embedding classifier score.
+        """
+        results = [scanner.scan(query)]
+        if self.embedding_safety is not None and query_embedding is not None:
+            results.append(self.embedding_safety.classify(query_embedding))
+        return merge_safety(*results)
+
+    def should_bypass_llm(self, best, safety):
+        """
+        True when the best pair is a near-duplicate of the query, so its
+        cleaned answer is returned as is. Flagged queries always go through
+        the LLM (and its safety prompt).
+        """
+        if self.bypass_score is None:
+            return False
+        # the threshold is a cosine similarity; fused / BM25 scores are not comparable
+        score = best.get("dense_score", best["score"])
+        return score is not None and score >= self.bypass_score and safety["level"] == "ok"
+
+    def fit_retrieved(self, query: str, best, query_embedding, max_new_tokens: int, model: str = None,
+                      n_tokens: int = None):
+        """
+        Returns (query, retrieved answer trimmed to the token budget,
+        max_new_tokens). Prompt + generated tokens must stay within
+        LLM_MAX_SEQ_LENGTH; when max_new_tokens leaves less than
+        MIN_RETRIEVED_TOKENS of context, it is lowered instead of cutting the
+        context away, and a query too long to leave room for that context is
+        cut to its leading part.
+        """
+        def count(text):
+            # counted without special tokens, PROMPT_TOKEN_MARGIN covers them
+            return self.budgeter.count_fn([text], model)[0] + PROMPT_TOKEN_MARGIN
+
+        max_query = LLM_MAX_SEQ_LENGTH - count(build_rephrase_prompt("", "")) - MIN_RETRIEVED_TOKENS - 1
+        query_tokens = count(query) - PROMPT_TOKEN_MARGIN
+        if query_tokens > max_query:
+            print(f"[AnswerService] query of {query_tokens} tokens cut to {max(max_query, 0)} "
+                  f"to keep {MIN_RETRIEVED_TOKENS} tokens of context")
+            profiler.count("query_truncated")
+            query = self._trim_query(query, query_tokens, max(max_query, 0), model)
+
+        overhead = count(build_rephrase_prompt(query, ""))
+        max_generated = max(LLM_MAX_SEQ_LENGTH - overhead - MIN_RETRIEVED_TOKENS, 1)
+        if max_new_tokens > max_generated:
+            print(f"[AnswerService] max_new_tokens {max_new_tokens} lowered to {max_generated} "
+                  f"to keep {MIN_RETRIEVED_TOKENS} tokens of context")
+            profiler.count("max_new_tokens_clamped")
+            max_new_tokens = max_generated
+
+        budget = min(self.budgeter.budget, LLM_MAX_SEQ_LENGTH - max_new_tokens - overhead)
+        text, _, truncated = self.budgeter.fit(
+            best["raw_response"], query_embedding, budget, model_name=model,
+            n_tokens=n_tokens,
+        )
+        if truncated:
+            profiler.count("context_truncated")
+        return query, text, max_new_tokens
+
+    def _trim_query(self, query: str, n_tokens: int, max_tokens: int, model: str = None):
+        """Leading part of `query` within max_tokens, cut at a word boundary."""
+        while n_tokens > max_tokens and query:
+            cut = min(int(len(query) * max_tokens / n_tokens), len(query) - 1)
+            query = query[:cut]
+            if " " in query:
+                query = query.rsplit(" ", 1)[0]
+            n_tokens = self.budgeter.count_fn([query], model)[0]
+        return query
 
     def extract_response(self, pair_text: str):
         """
         Extracts the response part from a stored Q/A pair.
         """
-        if "Response:" in pair_text:
-            return pair_text.split("Response:", 1)[1].strip()
-        return pair_text.strip()
+        return extract_response(pair_text)
 
     def clean(self, text: str):
         """
         Normalizes whitespace and limits output length for UI display.
         """
-        text = " ".join(text.split())
-        if len(text) <= MAX_DISPLAY_CHARS:
-            return text
-        return text[:MAX_DISPLAY_CHARS] + "..."
+        return clean_display(text)
+
+    def _derived_for(self, candidate):
+        # the generation the candidate was retrieved from, which may have been
+        # swapped out by a hot reload since
+        generation = candidate.get("generation")
+        return generation.derived if generation is not None else retriever.derived
+
+    def known_tokens(self, candidate, model: str = None):
+        """Response token count precomputed with the index for `model`, or None."""
+        derived = self._derived_for(candidate)
+        idx = candidate.get("id")
+        if derived is None or idx is None or derived.tokenizer != (model or DEFAULT_LLM):
+            return None
+        n = int(derived.tokens[idx])
+        return n if n >= 0 else None
+
+    def candidate_fields(self, candidate):
+        """
+        (raw response, display text, safety) of a retrieved pair. Looked up
+        from the fields precomputed with the index when available.
+        """
+        derived = self._derived_for(candidate)
+        idx = candidate.get("id")
+        if derived is not None and idx is not None:
+            scanner.reload_if_changed()
+            with profiler.span("derived_lookup"):
+                raw_response = derived.responses[idx]
+                cleaned = derived.display[idx]
+                # stored scans are only valid for the keyword set they were made with
+                safety = derived.safety(idx) if derived.safety_fingerprint == scanner.fingerprint else None
+            if safety is None:
+                with profiler.span("safety_check"):
+                    safety = self.safety_check(raw_response)
+            return raw_response, cleaned, safety
+
+        with profiler.span("extract_response"):
+            raw_response = self.extract_response(candidate["pair_text"])
+        with profiler.span("safety_check"):
+            safety = self.safety_check(raw_response)
+        with profiler.span("clean"):
+            cleaned = self.clean(raw_response)
+        return raw_response, cleaned, safety
 
     def answer(
         self,
@@ -46,27 +190,132 @@ class AnswerService:
         top_p: float = 0.9,
         max_new_tokens: int = 256,
         enable_safety_prompt: bool = True,
+        stream: bool = False,
+        model: str = None,
+        candidates=None,
+        query_embedding=None,
+        retrieval_mode: str = None,
+        use_cache: bool = True,
+        allow_bypass: bool = True,
     ):
         """
         Main pipeline entry point.
+        With stream=True (and use_llm), "llm_answer" is a generator of text chunks.
+        `model` is a config.LLM_MODELS name; None uses DEFAULT_LLM.
+        `retrieval_mode` is "dense", "bm25" or "hybrid"; None uses RETRIEVAL_MODE.
+        use_cache=False / allow_bypass=False always generate with the LLM
+        (evaluation scores the model, not the response cache or the bypass).
+        Pass `candidates` (from retriever.retrieve_many) to skip retrieval,
+        and `query_embedding` to skip re-encoding it for the safety, cache
+        and prompt-budget stages.
         """
+        with profiler.request() as timings:
+            out, request, cache_key = self._prepare_query(
+                query, k, candidates, query_embedding, retrieval_mode,
+                use_llm=use_llm,
+                system_prompt=system_prompt,
+                temperature=temperature,
+                top_p=top_p,
+                max_new_tokens=max_new_tokens,
+                enable_safety_prompt=enable_safety_prompt,
+                model=model,
+                use_cache=use_cache,
+                allow_bypass=allow_bypass,
+            )
+            self._generate(out, request, cache_key, stream)
 
-        # -------------------------
-        # 1) Retrieval
-        # -------------------------
-        candidates = retriever.retrieve(query, k)
+        # per-stage milliseconds; a streamed answer keeps filling it while consumed
+        out["timings"] = timings
+        return out
+
+    async def aanswer(
+        self,
+        query: str,
+        k: int = 5,
+        use_llm: bool = True,
+        system_prompt: str = "You are a helpful mental health AI.",
+        temperature: float = 0.2,
+        top_p: float = 0.9,
+        max_new_tokens: int = 256,
+        enable_safety_prompt: bool = True,
+        stream: bool = False,
+        model: str = None,
+        candidates=None,
+        query_embedding=None,
+        retrieval_mode: str = None,
+        use_cache: bool = True,
+        allow_bypass: bool = True,
+    ):
+        """
+        Coroutine version of answer() for serving many sessions from one event loop.
+        Embedding, FAISS and the other CPU-bound stages run in the default thread
+        pool; generation is awaited on the model's batching scheduler.
+        With stream=True (and use_llm), "llm_answer" is an async generator.
+        """
+        with profiler.request() as timings:
+            out, request, cache_key = await asyncio.to_thread(
+                self._prepare_query,
+                query, k, candidates, query_embedding, retrieval_mode,
+                use_llm=use_llm,
+                system_prompt=system_prompt,
+                temperature=temperature,
+                top_p=top_p,
+                max_new_tokens=max_new_tokens,
+                enable_safety_prompt=enable_safety_prompt,
+                model=model,
+                use_cache=use_cache,
+                allow_bypass=allow_bypass,
+            )
+            await self._agenerate(out, request, cache_key, stream)
+
+        out["timings"] = timings
+        return out
+
+    def _prepare_query(self, query: str, k: int, candidates=None, query_embedding=None, retrieval_mode=None,
+                       **kwargs):
+        """
+        Retrieval (unless `candidates` are given), then _prepare().
+        """
+        if candidates is None:
+            all_candidates, q_emb = retriever.retrieve_many(
+                [query], k, return_embeddings=True, mode=retrieval_mode
+            )
+            candidates, query_embedding = all_candidates[0], q_emb[0]
+        elif query_embedding is None:
+            # normally a query-cache hit from the retrieval that produced `candidates`
+            query_embedding = retriever.embed_queries([query])[0]
+        return self._prepare(query, candidates, query_embedding, **kwargs)
 
+    def _prepare(
+        self,
+        query: str,
+        candidates,
+        query_embedding=None,
+        use_llm: bool = True,
+        system_prompt: str = "You are a helpful mental health AI.",
+        temperature: float = 0.2,
+        top_p: float = 0.9,
+        max_new_tokens: int = 256,
+        enable_safety_prompt: bool = True,
+        model: str = None,
+        use_cache: bool = True,
+        allow_bypass: bool = True,
+    ):
+        """
+        Every stage before generation. Returns (out, rephrase kwargs, cache key);
+        the kwargs are None when out["llm_answer"] is already final, the cache
+        key is (bucket, query embedding) or None when the answer is not cached.
+        """
         if not candidates:
-            return {"error": "no_results"}
+            return {"error": "no_results"}, None, None
 
         processed = []
         for c in candidates:
-            raw_response = self.extract_response(c["pair_text"])
-            safety = self.safety_check(raw_response)
-            cleaned = self.clean(raw_response)
-
+            raw_response, cleaned, safety = self.candidate_fields(c)
             processed.append({
+                "id": c.get("id"),
                 "score": c["score"],
+                "dense_score": c.get("dense_score", c["score"]),
                 "raw_response": raw_response,
                 "cleaned_response": cleaned,
                 "metadata": c.get("metadata", {}),
@@ -75,33 +324,111 @@ class AnswerService:
 
         best = processed[0]
 
+        with profiler.span("query_safety"):
+            safety = merge_safety(best["safety"], self.query_safety(query, query_embedding))
+
+        out = {
+            "query": query,
+            "retrieved_answer": best["cleaned_response"],
+            "llm_answer": best["cleaned_response"],
+            "safety": safety,
+            "llm_bypassed": False,
+            "cached": False,
+            "candidates": processed
+        }
+        if not use_llm:
+            return out, None, None
+
         # -------------------------
-        # 2) LLM Rephrase (optional)
+        # 2) LLM Rephrase
         # -------------------------
-        if use_llm:
-            llm_answer = rephrase_answer(
-                query=query,
-                retrieved_answer=best["raw_response"],
+        if allow_bypass and self.should_bypass_llm(best, safety):
+            profiler.count("llm_bypassed")
+            out["llm_bypassed"] = True
+            return out, None, None
+
+        # high-risk answers are always generated fresh
+        cache_bucket = None
+        if use_cache and self.response_cache is not None and safety["level"] != "high":
+            cache_bucket = bucket_key(
+                # row ids change when an index is rebuilt; the retrieved text does not
+                content_hash(best["raw_response"]),
+                template=PROMPT_TEMPLATE_HASH,
+                model=model or DEFAULT_LLM,
+                system_prompt=system_prompt,
                 temperature=temperature,
                 top_p=top_p,
                 max_new_tokens=max_new_tokens,
-                system_prompt=system_prompt,
-                enable_safety_prompt=enable_safety_prompt
+                enable_safety_prompt=enable_safety_prompt,
             )
-        else:
-            llm_answer = best["cleaned_response"]
+            with profiler.span("response_cache"):
+                cached_answer = self.response_cache.get(cache_bucket, query_embedding)
+            profiler.count("response_cache_hit" if cached_answer is not None else "response_cache_miss")
+            if cached_answer is not None:
+                out["llm_answer"] = cached_answer
+                out["cached"] = True
+                return out, None, None
 
-        # -------------------------
-        # 3) Return final output
-        # -------------------------
-        return {
-            "query": query,
-            "retrieved_answer": best["cleaned_response"],
-            "llm_answer": llm_answer,
-            "safety": best["safety"],
-            "candidates": processed
+        profiler.count("llm_called")
+        with profiler.span("budget"):
+            prompt_query, retrieved_answer, max_new_tokens = self.fit_retrieved(
+                query, best, query_embedding, max_new_tokens, model,
+                n_tokens=self.known_tokens(candidates[0], model),
+            )
+        request = {
+            "query": prompt_query,
+            "retrieved_answer": retrieved_answer,
+            "temperature": temperature,
+            "top_p": top_p,
+            "max_new_tokens": max_new_tokens,
+            "system_prompt": system_prompt,
+            "enable_safety_prompt": enable_safety_prompt,
+            "model": model,
         }
+        cache_key = (cache_bucket, query_embedding) if cache_bucket is not None else None
+        return out, request, cache_key
+
+    def _generate(self, out, request, cache_key, stream: bool):
+        """Fills out["llm_answer"] (a generator of chunks when streaming)."""
+        if request is None:
+            if stream and (out.get("llm_bypassed") or out.get("cached")):
+                # callers expect chunks when streaming
+                out["llm_answer"] = iter([out["llm_answer"]])
+            return out
+
+        if stream:
+            llm_answer = stream_rephrase_answer(**request)
+            if cache_key is not None:
+                llm_answer = self.response_cache.caching_stream(*cache_key, llm_answer)
+        else:
+            llm_answer = rephrase_answer(**request)
+            if cache_key is not None and llm_answer:
+                self.response_cache.put(*cache_key, llm_answer)
+        out["llm_answer"] = llm_answer
+        return out
+
+    async def _agenerate(self, out, request, cache_key, stream: bool):
+        """Async counterpart of _generate (an async generator when streaming)."""
+        if request is None:
+            if stream and (out.get("llm_bypassed") or out.get("cached")):
+                out["llm_answer"] = _aiter_once(out["llm_answer"])
+            return out
+
+        if stream:
+            llm_answer = astream_rephrase_answer(**request)
+            if cache_key is not None:
+                llm_answer = self.response_cache.acaching_stream(*cache_key, llm_answer)
+        else:
+            llm_answer = await arephrase_answer(**request)
+            if cache_key is not None and llm_answer:
+                await asyncio.to_thread(self.response_cache.put, *cache_key, llm_answer)
+        out["llm_answer"] = llm_answer
+        return out
+
+
+async def _aiter_once(text):
+    yield text
 
 
-# Singleton instance
-answer_service = AnswerService()
+# Singleton instance, built on first use
+answer_service = Lazy("answer_service", AnswerService)
@@ -3,14 +3,22 @@ import streamlit as st
 import json
 from datetime import datetime
 import os
+import time
+from config import LLM_MODELS, DEFAULT_LLM
 
 # -------------------------
 # Try importing services
 # -------------------------
+# Heavy models are lazy singletons: importing is cheap, they load on first
+# use or in the warm-up thread started below.
 try:
-    from answer_service import answer_service
-    from voice.stt import speech_to_text      # Whisper tiny
-    from voice.tts import text_to_speech      # TTS
+    from startup import timed_import, warm_up, startup_report
+    answer_service = timed_import("answer_service").answer_service
+    llm_client = timed_import("llm_rephrase").llm_client
+    stt = timed_import("voice.stt")                          # Whisper tiny
+    speech_to_text = stt.speech_to_text
+    text_to_speech = timed_import("voice.tts").text_to_speech  # TTS
+    profiler = timed_import("profiler").profiler
 except Exception:
     st.error("importing faild answer_service or voice modules.")
     st.stop()
@@ -20,6 +28,29 @@ except Exception:
 # -------------------------
 st.set_page_config(page_title="Mental Health Assistant", page_icon="🧠", layout="wide")
 
+
+@st.cache_resource
+def _start_metrics_server():
+    # once per process, not per rerun
+    profiler.start_metrics_server()
+
+
+_start_metrics_server()
+
+
+@st.cache_resource
+def _warm_up_models():
+    # index + encoder first (needed by every request), then the default LLM
+    return warm_up(answer_service, llm_client, ("llm", lambda: llm_client.get_llm()))
+
+
+@st.cache_resource
+def _warm_up_whisper():
+    return warm_up(stt.model)
+
+
+_warm_up_models()
+
 st.title("🧠 Mental Health Assistant — RAG + LLM + Voice")
 st.caption("Retrieval (pair-embeddings) + LLM rephrase (Unsloth) + Safety checks + Voice")
 
@@ -32,24 +63,22 @@ with st.sidebar:
     use_llm = st.checkbox("Use LLM Rephrase", value=True)
     show_context = st.checkbox("Show Retrieved Context", value=False)
     show_llm_raw = st.checkbox("Show raw LLM output", value=False)
+    show_timings = st.checkbox("Show stage timings", value=False)
 
     st.markdown("---")
 
     st.header("LLM Settings")
 
-    # Model selector (UI only)
+    # Model selector (loaded on first use, least recently used model is evicted)
     selected_model = st.selectbox(
         "Choose LLM Model",
-        [
-            "Llama-3.2-3B-Instruct (Active)",
-            "Gemma-3-4B (Demo)",
-            "Mistral-7B (Demo)"
-        ],
-        index=0
+        list(LLM_MODELS),
+        index=list(LLM_MODELS).index(DEFAULT_LLM),
+        format_func=lambda name: LLM_MODELS[name]["label"],
     )
 
     st.caption(
-        "ℹ️ Model switching "
+        "ℹ️ Switching models loads the new one on the next request"
     )
 
     system_prompt = st.text_area(
@@ -71,10 +100,29 @@ with st.sidebar:
     st.header("Voice Settings")
     use_voice_input = st.checkbox("🎙️ Voice Input", value=False)
     use_voice_output = st.checkbox("🔊 Voice Output", value=True)
+    if use_voice_input:
+        _warm_up_whisper()
 
     st.markdown("---")
     st.caption("Tip: Use the settings carefully when testing performance or cost.")
 
+    if show_timings:
+        with st.expander("🚀 Startup timings (ms)"):
+            report = startup_report()
+            rows = [(kind, name, round(ms, 1)) for kind, values in report.items() for name, ms in values.items()]
+            st.table({
+                "kind": [r[0] for r in rows],
+                "name": [r[1] for r in rows],
+                "ms": [r[2] for r in rows],
+            })
+        with st.expander("📊 Pipeline counters"):
+            # LLM scheduler queue depth / batch sizes, cache hits, bypasses ...
+            levels = {**profiler.counts(), **profiler.gauges()}
+            st.table({
+                "metric": list(levels),
+                "value": list(levels.values()),
+            })
+
 # -------------------------
 # Main Input Section
 # -------------------------
@@ -140,7 +188,7 @@ if run_button:
         st.warning("Please enter or record a message first.")
     else:
         try:
-            with st.spinner("Processing — retrieving and (optionally) rephrasing..."):
+            with st.spinner("Processing — retrieving..."):
                 out = answer_service.answer(
                     query=query,
                     k=k,
@@ -150,6 +198,8 @@ if run_button:
                     top_p=top_p,
                     max_new_tokens=max_new_tokens,
                     enable_safety_prompt=enable_safety_prompt,
+                    stream=use_llm,
+                    model=selected_model,
                 )
         except Exception as e:
             st.exception(f"Error running pipeline: {e}")
@@ -157,13 +207,26 @@ if run_button:
 
         if out:
             st.subheader("💡 Assistant Response")
-            llm_text = out.get("llm_answer") or out.get("retrieved_answer") or "No answer returned."
-            st.markdown(llm_text)
+            if use_llm and "llm_answer" in out:
+                # render tokens as they are generated
+                try:
+                    out["llm_answer"] = st.write_stream(out["llm_answer"]).strip()
+                except Exception as e:
+                    st.exception(f"Error generating answer: {e}")
+                    out["llm_answer"] = ""
+                llm_text = out["llm_answer"] or out.get("retrieved_answer") or "No answer returned."
+                if out.get("llm_bypassed"):
+                    st.caption("Near-identical question in the dataset — answered without the LLM.")
+            else:
+                llm_text = out.get("llm_answer") or out.get("retrieved_answer") or "No answer returned."
+                st.markdown(llm_text)
 
             # -------- Voice Output --------
             if use_voice_output:
                 with st.spinner("Generating voice response..."):
+                    t0 = time.perf_counter()
                     audio_out = text_to_speech(llm_text)
+                    out.setdefault("timings", {})["tts"] = (time.perf_counter() - t0) * 1000
 
                 if audio_out and os.path.exists(audio_out):
                     st.audio(audio_out)
@@ -194,6 +257,16 @@ if run_button:
                 st.subheader("🔍 Raw LLM Output")
                 st.code(llm_text, language="text")
 
+            # -------- Stage timings --------
+            if show_timings and out.get("timings"):
+                with st.expander("⏱ Stage timings (ms)"):
+                    timings = out["timings"]
+                    st.table({
+                        "stage": list(timings),
+                        "ms": [round(v, 2) for v in timings.values()],
+                    })
+                    st.caption(f"Total: {sum(timings.values()):.1f} ms")
+
             # -------- Save history --------
             st.session_state["history"].append({
                 "timestamp": datetime.utcnow().isoformat() + "Z",
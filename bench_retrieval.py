@@ -0,0 +1,168 @@
+"""
+Retrieval-only benchmark over cleaned_dataset.json.
+
+Each dataset instruction (plus deterministic paraphrase variants of it) is
+used as a query; the relevant document is the pair built from that item.
+Reports recall@1/5/10, MRR@10 and p50/p95/p99 encode and search latency
+for every index variant / embedding model and retrieval mode given:
+
+    python bench_retrieval.py
+    python bench_retrieval.py --variant ./faiss_index_pair_v1 \
+        --variant ./faiss_index_pair_hnsw --variant ./faiss_index_minilm
+
+The query encoder is the embed_model recorded in each index's
+index_info.json (`INDEX_DIR:MODEL` overrides it).
+    python bench_retrieval.py --mode dense --mode bm25 --mode hybrid
+"""
+import argparse
+import json
+import random
+import re
+import time
+import numpy as np
+from loader import PairIndexLoader, read_index_info
+from retriever import PairRetriever, MODES
+from encoder import BACKENDS
+from config import DATASET_PATH, INDEX_DIR, EMBEDDING_MODEL, ENCODER_BACKEND
+
+KS = (1, 5, 10)
+VARIANTS = ("exact", "lowercase_nopunct", "question_only", "truncated", "word_dropout")
+
+
+def make_variants(text, seed=0):
+    """
+    Cheap, deterministic paraphrase-like rewrites of a query.
+    """
+    rng = random.Random(seed)
+    words = text.split()
+    sentences = [s for s in re.split(r"(?<=[.!?])\s+", text) if s.strip()]
+    questions = [s for s in sentences if s.endswith("?")]
+
+    kept = [w for w in words if rng.random() > 0.15] or words
+    return {
+        "exact": text,
+        "lowercase_nopunct": re.sub(r"[^\w\s]", "", text.lower()),
+        "question_only": questions[-1] if questions else sentences[-1] if sentences else text,
+        "truncated": " ".join(words[:max(1, len(words) // 2)]),
+        "word_dropout": " ".join(kept),
+    }
+
+
+def percentiles(values_ms):
+    return {
+        "p50": float(np.percentile(values_ms, 50)),
+        "p95": float(np.percentile(values_ms, 95)),
+        "p99": float(np.percentile(values_ms, 99)),
+    }
+
+
+def relevant_ids(retriever, n_items):
+    """
+    dataset position -> index row. Pairs carry 1-based seq_num metadata;
+    fall back to row order when it is missing. Rows emptied by an
+    incremental ingest have no metadata and are skipped.
+    """
+    mapping = {}
+    for row in range(len(retriever.meta)):
+        seq = retriever.meta[row].get("seq_num")
+        if seq:
+            mapping[seq - 1] = row
+    if not mapping:
+        return list(range(n_items))
+    return [mapping.get(i, -1) for i in range(n_items)]
+
+
+def bench_variant(index_dir, model_name, items, variants=VARIANTS, limit=None, backend=ENCODER_BACKEND,
+                  mode="dense"):
+    info = read_index_info(index_dir)
+    index_type = info.get("index_type", "flat")
+    model_name = model_name or info.get("embed_model", EMBEDDING_MODEL)
+
+    retriever = PairRetriever(
+        PairIndexLoader(
+            index_dir=index_dir, index_type=index_type, embedding_model=model_name, encoder_backend=backend
+        ).load(),
+        reload_interval=None,
+    )
+    # measure the encoder itself, not the query cache
+    retriever.query_cache = None
+    if mode != "dense":
+        retriever.loader.lexical  # built once, outside the timed loop
+
+    items = items[:limit] if limit else items
+    targets = relevant_ids(retriever, len(items))
+    max_k = max(KS)
+
+    report = {
+        "index_dir": index_dir, "index_type": index_type, "embedding_model": model_name,
+        "encoder_backend": backend, "mode": mode, "variants": {},
+    }
+    for variant in variants:
+        hits = {k: 0 for k in KS}
+        rr = []
+        encode_ms, search_ms = [], []
+
+        for i, item in enumerate(items):
+            query = make_variants(item["instruction"], seed=i)[variant]
+
+            t0 = time.perf_counter()
+            q_emb = retriever.embed_queries([query]) if mode != "bm25" else None
+            t1 = time.perf_counter()
+            ranked, _ = retriever.rank([query], q_emb, max_k, mode)[0]
+            t2 = time.perf_counter()
+            encode_ms.append((t1 - t0) * 1000)
+            search_ms.append((t2 - t1) * 1000)
+
+            ranked = [idx for idx, _ in ranked]
+            rank = ranked.index(targets[i]) + 1 if targets[i] in ranked else None
+            for k in KS:
+                if rank is not None and rank <= k:
+                    hits[k] += 1
+            rr.append(1.0 / rank if rank else 0.0)
+
+        n = len(items)
+        report["variants"][variant] = {
+            **{f"recall@{k}": hits[k] / n for k in KS},
+            f"mrr@{max_k}": float(np.mean(rr)),
+            "encode_ms": percentiles(encode_ms),
+            "search_ms": percentiles(search_ms),
+            "queries": n,
+        }
+        print(f"[Bench] {index_dir} | {model_name} | {mode} | {variant}: "
+              f"R@1={hits[1] / n:.3f} R@5={hits[5] / n:.3f} R@10={hits[10] / n:.3f} "
+              f"MRR={np.mean(rr):.3f} search_p95={report['variants'][variant]['search_ms']['p95']:.2f}ms")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark retrieval quality and latency")
+    parser.add_argument("--dataset", default=DATASET_PATH)
+    parser.add_argument(
+        "--variant", action="append",
+        help="INDEX_DIR[:MODEL], repeatable (default: config INDEX_DIR); MODEL defaults to the index's embed_model",
+    )
+    parser.add_argument("--backend", choices=BACKENDS, default=ENCODER_BACKEND, help="query encoder backend")
+    parser.add_argument("--mode", action="append", choices=MODES, help="retrieval mode, repeatable (default: dense)")
+    parser.add_argument("--queries", nargs="+", choices=VARIANTS, default=list(VARIANTS))
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--out", default="bench_retrieval.json")
+    args = parser.parse_args()
+
+    with open(args.dataset, "r", encoding="utf-8") as f:
+        items = json.load(f)
+
+    reports = []
+    for spec in args.variant or [INDEX_DIR]:
+        index_dir, _, model_name = spec.partition(":")
+        for mode in args.mode or ["dense"]:
+            reports.append(bench_variant(
+                index_dir, model_name or None, items, args.queries, args.limit, args.backend, mode
+            ))
+
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump({"dataset": args.dataset, "results": reports}, f, ensure_ascii=False, indent=2)
+    print(f"[Bench] Report written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
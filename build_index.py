@@ -0,0 +1,193 @@
+"""
+Builds a FAISS index over cleaned_dataset.json.
+
+    python build_index.py --type hnsw --M 32 --efSearch 64
+    python build_index.py --type ivf_pq --nlist 32 --pq_m 16 --nprobe 8
+    python build_index.py --model sentence-transformers/all-MiniLM-L6-v2 --out ./faiss_index_minilm
+
+Every build reports recall@k of the chosen variant against an exact
+IndexFlatIP over the same vectors, plus per-query search latency.
+"""
+import argparse
+import json
+import os
+import re
+import time
+import faiss
+import numpy as np
+from text_store import write_text_store
+from derived_fields import compute_derived, write_derived
+from loader import new_generation_dir, publish_generation
+from config import (
+    DATASET_PATH, EMBEDDING_MODEL, ENCODE_BATCH_SIZE,
+    INDEX_DIRS, INDEX_PARAMS,
+)
+
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq")
+
+# same light PII redaction the original notebook applied
+EMAIL_RE = re.compile(r'[\w\.-]+@[\w\.-]+\.\w+')
+PHONE_RE = re.compile(r'(\+?\d[\d\-\s]{6,}\d)')
+
+
+def redact_pii(text):
+    text = EMAIL_RE.sub("[REDACTED_EMAIL]", text)
+    text = PHONE_RE.sub("[REDACTED_PHONE]", text)
+    return text
+
+
+def load_pairs(dataset_path=DATASET_PATH):
+    """
+    Turns the cleaned dataset into (texts, metadatas) in the stored pair format.
+    """
+    with open(dataset_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    texts, metadatas = [], []
+    for i, item in enumerate(data, start=1):
+        instruction = str(item.get("instruction") or "").strip()
+        response = str(item.get("response") or "").strip()
+        texts.append(f"Instruction: {redact_pii(instruction)}\nResponse: {redact_pii(response)}")
+        metadatas.append({
+            "source": dataset_path,
+            "seq_num": i,
+            "orig_length": len(instruction) + len(response),
+            "has_response": bool(response),
+            "pair_type": "inst_resp_pair",
+        })
+    return texts, metadatas
+
+
+def instruction_of(pair_text):
+    return pair_text.split("\nResponse:", 1)[0].replace("Instruction:", "", 1).strip()
+
+
+def embed_texts(embedder, texts, batch_size=ENCODE_BATCH_SIZE):
+    embs = embedder.encode(
+        texts, batch_size=batch_size, convert_to_numpy=True, show_progress_bar=True
+    ).astype("float32")
+    faiss.normalize_L2(embs)
+    return embs
+
+
+def build_faiss_index(embs, index_type="flat", params=None):
+    """
+    Inner-product index (cosine on normalized vectors) of the given type.
+    """
+    params = dict(INDEX_PARAMS.get(index_type, {}), **(params or {}))
+    d = embs.shape[1]
+
+    if index_type == "flat":
+        index = faiss.IndexFlatIP(d)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(d, params["M"], faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = params["efConstruction"]
+    elif index_type == "ivf_flat":
+        quantizer = faiss.IndexFlatIP(d)
+        index = faiss.IndexIVFFlat(quantizer, d, params["nlist"], faiss.METRIC_INNER_PRODUCT)
+    elif index_type == "ivf_pq":
+        quantizer = faiss.IndexFlatIP(d)
+        index = faiss.IndexIVFPQ(
+            quantizer, d, params["nlist"], params["pq_m"], params["pq_nbits"],
+            faiss.METRIC_INNER_PRODUCT,
+        )
+    else:
+        raise ValueError(f"Unknown index type: {index_type}")
+
+    if not index.is_trained:
+        index.train(embs)
+    index.add(embs)
+
+    if index_type == "hnsw":
+        index.hnsw.efSearch = params["efSearch"]
+    elif index_type in ("ivf_flat", "ivf_pq"):
+        index.nprobe = params["nprobe"]
+    return index
+
+
+def recall_vs_flat(index, embs, queries, ks=(1, 5, 10)):
+    """
+    recall@k of `index` against exact search over `embs`, and search latency.
+    """
+    max_k = max(ks)
+    exact = faiss.IndexFlatIP(embs.shape[1])
+    exact.add(embs)
+    _, truth = exact.search(queries, max_k)
+
+    latencies = []
+    found = np.empty_like(truth)
+    for i in range(len(queries)):
+        t0 = time.perf_counter()
+        _, ids = index.search(queries[i:i + 1], max_k)
+        latencies.append((time.perf_counter() - t0) * 1000)
+        found[i] = ids[0]
+
+    report = {}
+    for k in ks:
+        hits = [len(set(truth[i, :k]) & set(found[i, :k])) for i in range(len(queries))]
+        report[f"recall@{k}"] = float(np.mean(hits) / k)
+    report["search_ms_p50"] = float(np.percentile(latencies, 50))
+    report["search_ms_p95"] = float(np.percentile(latencies, 95))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a FAISS index over the cleaned dataset")
+    parser.add_argument("--type", choices=INDEX_TYPES, default="flat")
+    parser.add_argument("--dataset", default=DATASET_PATH)
+    parser.add_argument("--out", default=None, help="defaults to INDEX_DIRS[type] from config.py")
+    parser.add_argument("--model", default=EMBEDDING_MODEL, help="embedding model, recorded in index_info.json")
+    parser.add_argument("--M", type=int)
+    parser.add_argument("--efConstruction", type=int)
+    parser.add_argument("--efSearch", type=int)
+    parser.add_argument("--nlist", type=int)
+    parser.add_argument("--nprobe", type=int)
+    parser.add_argument("--pq_m", type=int)
+    parser.add_argument("--pq_nbits", type=int)
+    args = parser.parse_args()
+
+    params = {
+        name: getattr(args, name)
+        for name in ("M", "efConstruction", "efSearch", "nlist", "nprobe", "pq_m", "pq_nbits")
+        if getattr(args, name) is not None
+    }
+    params = dict(INDEX_PARAMS.get(args.type, {}), **params)
+    out_dir = args.out or INDEX_DIRS[args.type]
+
+    from encoder import load_encoder
+
+    texts, metadatas = load_pairs(args.dataset)
+    print(f"[Build] Embedding {len(texts)} pairs with {args.model}")
+    # corpus vectors always come from the original (torch) model
+    embedder = load_encoder(args.model, backend="torch")
+    embs = embed_texts(embedder, texts)
+    # the dataset instructions double as the recall query set
+    queries = embed_texts(embedder, [instruction_of(t) for t in texts])
+
+    index = build_faiss_index(embs, args.type, params)
+    report = recall_vs_flat(index, embs, queries)
+    print(f"[Build] {args.type} {params}: {json.dumps(report)}")
+
+    # never overwrite files that running workers may have memory-mapped:
+    # every build is a new generation, switched to atomically (see loader)
+    os.makedirs(out_dir, exist_ok=True)
+    generation, target_dir = new_generation_dir(out_dir)
+
+    faiss.write_index(index, os.path.join(target_dir, "index.faiss"))
+    write_text_store(target_dir, texts, metadatas)
+    write_derived(target_dir, compute_derived(texts))
+    with open(os.path.join(target_dir, "index_info.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "index_type": args.type,
+            "params": params,
+            "embed_model": args.model,
+            "n_items": index.ntotal,
+            "recall_vs_flat": report,
+            "generation": generation,
+        }, f, ensure_ascii=False, indent=2)
+
+    publish_generation(out_dir, generation)
+    print(f"[Build] Saved {index.ntotal} vectors to {out_dir} as {generation}")
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,85 @@
-INDEX_DIR = "./faiss_index_pair_v1"
+# Index variant (build others with: python build_index.py --type hnsw)
+INDEX_TYPE = "flat"   # flat | hnsw | ivf_flat | ivf_pq
+INDEX_DIRS = {
+    "flat": "./faiss_index_pair_v1",
+    "hnsw": "./faiss_index_pair_hnsw",
+    "ivf_flat": "./faiss_index_pair_ivf_flat",
+    "ivf_pq": "./faiss_index_pair_ivf_pq",
+}
+INDEX_DIR = INDEX_DIRS[INDEX_TYPE]
+# build-time params + search-time params (nprobe / efSearch are applied on load)
+INDEX_PARAMS = {
+    "flat": {},
+    "hnsw": {"M": 32, "efConstruction": 200, "efSearch": 64},
+    "ivf_flat": {"nlist": 32, "nprobe": 8},
+    "ivf_pq": {"nlist": 32, "pq_m": 16, "pq_nbits": 8, "nprobe": 8},
+}
+DATASET_PATH = "./cleaned_dataset.json"
+INDEX_MMAP = True     # mmap index.faiss read-only on first search (shared page cache)
+INDEX_RELOAD_INTERVAL = 10.0   # seconds between checks of INDEX_DIR/CURRENT for a new generation, None = off
 EMBEDDING_MODEL = "all-mpnet-base-v2"
-DEVICE = "cuda"       # غيّر لـ "cuda" لو عايز GPU
+DEVICE = "cuda"       # غيّر لـ "cuda" لو عايز GPU (falls back to cpu when CUDA is unavailable)
+ENCODER_BACKEND = "torch"   # torch | onnx | onnx_int8 (check with: python encoder.py --backend onnx_int8)
+ENCODER_EXPORT_DIR = "./cache/encoders"   # exported / quantized ONNX graphs
+ENCODER_INT8_CONFIG = "avx2"   # avx2 | avx512 | avx512_vnni | arm64
 TOP_K = 5
+RETRIEVAL_MODE = "dense"   # dense | bm25 | hybrid (FAISS + in-process BM25), per call via mode=
+HYBRID_FUSION = "rrf"      # rrf | weighted
+HYBRID_DEPTH = 50          # candidates taken from each retriever before fusion
+HYBRID_DENSE_WEIGHT = 0.5  # weighted fusion only: share of the min-max normalized dense score
+RRF_K = 60
+BM25_K1 = 1.2
+BM25_B = 0.75
+ENCODE_BATCH_SIZE = 64   # queries per embedder.encode call in retrieve_many
+
+# Query-embedding cache (in front of the encoder)
+QUERY_CACHE_SIZE = 2048   # 0 disables the cache
+QUERY_CACHE_TTL = 24 * 3600   # seconds, None = never expire
+QUERY_CACHE_PATH = None   # e.g. "./cache/query_embeddings.sqlite" to persist across restarts
 MAX_DISPLAY_CHARS = 1200
 
+# Per-stage timing (returned as answer["timings"], optionally exported to Prometheus)
+PROFILING = True
+PROMETHEUS_METRICS = False   # needs prometheus_client
+PROMETHEUS_PORT = None       # e.g. 9100 to serve /metrics
+
+# LLM registry: loaded lazily by name, LRU-evicted beyond these limits
+LLM_MODELS = {
+    "llama": {"model_id": "unsloth/Llama-3.2-3B-Instruct", "label": "Llama-3.2-3B-Instruct", "approx_gb": 2.5},
+    "gemma": {"model_id": "google/gemma-3-4b-it", "label": "Gemma-3-4B", "approx_gb": 3.5},
+    "mistral": {"model_id": "unsloth/mistral-7b-instruct-v0.3-bnb-4bit", "label": "Mistral-7B", "approx_gb": 4.5},
+}
+DEFAULT_LLM = "llama"
+LLM_MAX_RESIDENT = 1
+LLM_MEMORY_BUDGET_GB = None   # e.g. 12 to allow several small models on one GPU
+
+# LLM request batching (for concurrent sessions)
+LLM_BATCHING = False      # route rephrase requests through the batching scheduler
+LLM_MAX_BATCH_SIZE = 8
+LLM_MAX_WAIT_MS = 20      # how long the scheduler waits for a batch to fill
+
+# Evaluation runner
+# concurrent generations in run_pipeline, enough to fill one scheduler batch;
+# without batching, model.generate is not thread-safe
+EVAL_WORKERS = LLM_MAX_BATCH_SIZE if LLM_BATCHING else 1
+EVAL_CHECKPOINT = "./eval_checkpoint.jsonl"
+
+# Prompt length: the retrieved answer is trimmed to fit, never the prompt tail
+LLM_MAX_SEQ_LENGTH = 2048
+RETRIEVED_TOKEN_BUDGET = 768   # max tokens of retrieved answer in the rephrase prompt
+MIN_RETRIEVED_TOKENS = 128     # context always kept; max_new_tokens is lowered to make room for it
+PROMPT_TOKEN_MARGIN = 8        # special tokens (BOS) and merges around the inserted texts, not in the counts
+
+# Skip the LLM when the top retrieval is a near-duplicate of the query
+LLM_BYPASS_SCORE = 0.95   # cosine of the best pair; None always rephrases
+
+# Semantic cache of final LLM answers (same top pair + generation params)
+RESPONSE_CACHE = True
+RESPONSE_CACHE_THRESHOLD = 0.97   # query-embedding cosine for a hit
+RESPONSE_CACHE_SIZE = 1024
+RESPONSE_CACHE_TTL = 7 * 24 * 3600   # seconds, None = never expire
+RESPONSE_CACHE_PATH = "./cache/responses.sqlite"   # None keeps it in memory only
+
 SELFHARM_KEYWORDS = [
     "suicide", "kill myself", "end my life", "hurt myself", "i want to die"
 ]
@@ -11,3 +87,39 @@ SELFHARM_KEYWORDS = [
 ABUSE_KEYWORDS = [
     "he hit me", "he abused", "sexual abuse", "domestic violence"
 ]
+
+# Severity of each keyword category (the most severe match wins)
+SAFETY_CATEGORIES = {
+    "self_harm": {"level": "high", "reason": "self harm"},
+    "abuse": {"level": "medium", "reason": "abuse"},
+}
+SAFETY_KEYWORDS_PATH = None    # JSON {"category": [keywords]} replacing the lists above, reloaded on change
+SAFETY_RELOAD_INTERVAL = 5.0   # seconds between checks of the keywords file
+
+# Embedding safety stage: the query embedding vs. per-category prototype sentences.
+# Off until the thresholds are calibrated with `python safety.py` (rate of
+# dataset instructions each threshold flags without a keyword match)
+SAFETY_EMBEDDING = False
+SAFETY_EMBEDDING_THRESHOLDS = {   # cosine to the closest prototype of the category
+    "self_harm": 0.60,
+    "abuse": 0.60,
+}
+SAFETY_PROTOTYPES = {
+    "self_harm": [
+        "I want to kill myself",
+        "I don't want to live anymore",
+        "I have been thinking about ending my life",
+        "I keep cutting myself to cope",
+        "Everyone would be better off without me",
+        "I have a plan to take my own life",
+        "I want to disappear and never wake up",
+    ],
+    "abuse": [
+        "My partner hits me when he is angry",
+        "I am being physically abused at home",
+        "My husband threatens and hurts me",
+        "I was sexually assaulted",
+        "My parents beat me",
+        "I am afraid of my partner because he is violent",
+    ],
+}
@@ -0,0 +1,119 @@
+"""
+Token budgeting for the retrieved answer placed in the rephrase prompt.
+
+A retrieved response that fits the budget is used as is. A longer one is
+split into sentences and the sentences most similar to the query are kept,
+in their original order, until the budget is filled, so the prompt never
+reaches the tokenizer's truncation (which would cut the final instructions).
+Token counts use the generating model's tokenizer (loaded on its own, without
+the weights); per-document counts and sentence data are computed once.
+"""
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+import numpy as np
+from text_store import content_hash
+from config import LLM_MODELS, DEFAULT_LLM, RETRIEVED_TOKEN_BUDGET
+
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+
+def split_sentences(text: str):
+    return [s.strip() for s in _SENTENCE_RE.split(text) if s.strip()]
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer(model_name: str = None):
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(LLM_MODELS[model_name or DEFAULT_LLM]["model_id"])
+
+
+def count_tokens(texts, model_name: str = None):
+    """Token count of each text, without special tokens."""
+    if not texts:
+        return []
+    ids = get_tokenizer(model_name)(list(texts), add_special_tokens=False)["input_ids"]
+    return [len(x) for x in ids]
+
+
+class ContextBudgeter:
+    def __init__(self, encode_fn, count_fn=count_tokens, budget: int = RETRIEVED_TOKEN_BUDGET, max_docs: int = 4096):
+        """
+        encode_fn(texts) -> L2-normalized float32 matrix, same encoder as the query embedding
+        count_fn(texts, model_name) -> list of token counts
+        """
+        self.encode_fn = encode_fn
+        self.count_fn = count_fn
+        self.budget = budget
+        self.max_docs = max_docs
+        # keyed by content hash: row ids change when an index is rebuilt
+        self._doc_tokens = OrderedDict()   # (model, text hash) -> token count
+        self._sentences = OrderedDict()    # (model, text hash) -> (sentences, token counts, embeddings)
+        self._lock = threading.Lock()
+
+    def doc_tokens(self, text: str, model_name: str = None) -> int:
+        key = (model_name or DEFAULT_LLM, content_hash(text))
+        with self._lock:
+            if key in self._doc_tokens:
+                return self._doc_tokens[key]
+        n = self.count_fn([text], model_name)[0]
+        with self._lock:
+            self._doc_tokens[key] = n
+            while len(self._doc_tokens) > self.max_docs:
+                self._doc_tokens.popitem(last=False)
+        return n
+
+    def _sentence_data(self, text: str, model_name: str = None):
+        key = (model_name or DEFAULT_LLM, content_hash(text))
+        with self._lock:
+            data = self._sentences.get(key)
+            if data is not None:
+                self._sentences.move_to_end(key)
+                return data
+
+        sentences = split_sentences(text)
+        data = (
+            sentences,
+            np.asarray(self.count_fn(sentences, model_name), dtype="int64"),
+            np.asarray(self.encode_fn(sentences), dtype="float32"),
+        )
+        with self._lock:
+            self._sentences[key] = data
+            while len(self._sentences) > self.max_docs:
+                self._sentences.popitem(last=False)
+        return data
+
+    def fit(self, text: str, query_embedding, budget: int = None, model_name: str = None, n_tokens: int = None):
+        """
+        Returns (text, token count, truncated). The text is unchanged when it
+        fits `budget` tokens; otherwise the most query-similar sentences that fit.
+        `n_tokens` is the token count when already known (see derived_fields).
+        """
+        budget = self.budget if budget is None else budget
+        if budget < 1:
+            raise ValueError(f"Token budget must be positive, got {budget}")
+        n = n_tokens if n_tokens is not None else self.doc_tokens(text, model_name)
+        if n <= budget:
+            return text, n, False
+
+        sentences, lengths, embs = self._sentence_data(text, model_name)
+        if not sentences:
+            return text, n, False
+        sims = embs @ np.asarray(query_embedding, dtype="float32").reshape(-1)
+
+        keep, used = [], 0
+        for i in np.argsort(-sims):
+            # +1 for the joining space
+            if used + lengths[i] + 1 <= budget:
+                keep.append(i)
+                used += int(lengths[i]) + 1
+        if not keep:
+            # even the best sentence is over budget: keep its leading words
+            best = int(np.argmax(sims))
+            words = sentences[best].split()
+            words = words[:max(1, len(words) * budget // max(1, int(lengths[best])))]
+            text = " ".join(words)
+            return text, self.count_fn([text], model_name)[0], True
+        return " ".join(sentences[i] for i in sorted(keep)), used, True
@@ -0,0 +1,193 @@
+"""
+Per-document fields derived from the pair texts.
+
+None of them depend on the query, so they are computed once, when the index
+is built (or first loaded without them), and stored next to it:
+- responses.bin / responses.offsets.npy   response part of each pair
+- display.bin / display.offsets.npy       whitespace-normalized, length-capped text
+- safety.bin / safety.offsets.npy         keyword scan of the response, JSON per row
+- derived.tokens.npy                      int32 response token count, -1 if unknown
+- derived.json                            settings the fields were computed with
+
+They are recomputed on load when those settings no longer match.
+"""
+import argparse
+import json
+import os
+import pickle
+import numpy as np
+from text_store import TextStore, write_texts, has_text_store, atomic_write
+from safety import scanner
+from config import INDEX_DIR, MAX_DISPLAY_CHARS, DEFAULT_LLM
+
+INFO_FILE = "derived.json"
+TOKENS_FILE = "derived.tokens.npy"
+COLUMNS = ("responses", "display", "safety")
+
+
+def extract_response(pair_text: str):
+    """
+    Extracts the response part from a stored Q/A pair.
+    """
+    if "Response:" in pair_text:
+        return pair_text.split("Response:", 1)[1].strip()
+    return pair_text.strip()
+
+
+def clean_display(text: str, max_chars: int = MAX_DISPLAY_CHARS):
+    """
+    Normalizes whitespace and limits output length for UI display.
+    """
+    text = " ".join(text.split())
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars] + "..."
+
+
+def _token_counts(texts, model_name, batch_size=512):
+    try:
+        from context_budget import count_tokens
+
+        counts = []
+        for start in range(0, len(texts), batch_size):
+            counts.extend(count_tokens(texts[start:start + batch_size], model_name))
+        return counts, model_name
+    except (ImportError, OSError, ValueError) as e:
+        print(f"[Derived] No tokenizer for {model_name} ({e}); token counts left empty")
+        return [-1] * len(texts), None
+
+
+class DerivedFields:
+    """
+    Row-aligned lookups of the derived fields (lists or memory-mapped stores).
+    """
+
+    def __init__(self, responses, display, safety, tokens, info):
+        self.responses = responses
+        self.display = display
+        self._safety = safety
+        self.tokens = tokens
+        self.info = info
+
+    def __len__(self):
+        return len(self.responses)
+
+    @property
+    def safety_fingerprint(self):
+        return self.info.get("safety_fingerprint")
+
+    @property
+    def tokenizer(self):
+        """LLM name the token counts were made with (None if unknown)."""
+        return self.info.get("tokenizer")
+
+    def safety(self, idx):
+        return json.loads(self._safety[idx])
+
+
+def compute_derived(texts, model_name: str = DEFAULT_LLM):
+    responses = [extract_response(t) for t in texts]
+    tokens, tokenizer = _token_counts(responses, model_name)
+    info = {
+        "rows": len(responses),
+        "max_display_chars": MAX_DISPLAY_CHARS,
+        "safety_fingerprint": scanner.fingerprint,
+        "tokenizer": tokenizer,
+    }
+    return DerivedFields(
+        responses,
+        [clean_display(r) for r in responses],
+        [json.dumps(scanner.scan(r), ensure_ascii=False) for r in responses],
+        np.asarray(tokens, dtype=np.int32),
+        info,
+    )
+
+
+def write_derived(index_dir, derived: DerivedFields):
+    """
+    Every file is replaced atomically, so processes that have the previous
+    fields mapped keep reading them until they reopen.
+    """
+    info_path = os.path.join(index_dir, INFO_FILE)
+    if os.path.exists(info_path):
+        os.remove(info_path)
+    write_texts(index_dir, derived.responses, "responses")
+    write_texts(index_dir, derived.display, "display")
+    write_texts(index_dir, derived._safety, "safety")
+    with atomic_write(os.path.join(index_dir, TOKENS_FILE)) as f:
+        np.save(f, np.asarray(derived.tokens, dtype=np.int32))
+    # written last: its presence marks a complete set
+    with atomic_write(info_path, "w", encoding="utf-8") as f:
+        json.dump(derived.info, f, ensure_ascii=False, indent=2)
+
+
+def open_derived(index_dir):
+    with open(os.path.join(index_dir, INFO_FILE), "r", encoding="utf-8") as f:
+        info = json.load(f)
+    return DerivedFields(
+        TextStore(index_dir, "responses"),
+        TextStore(index_dir, "display"),
+        TextStore(index_dir, "safety"),
+        np.load(os.path.join(index_dir, TOKENS_FILE), mmap_mode="r"),
+        info,
+    )
+
+
+def _tokenizer_available(model_name):
+    try:
+        from context_budget import get_tokenizer
+
+        get_tokenizer(model_name)
+        return True
+    except (ImportError, OSError, ValueError):
+        return False
+
+
+def _is_current(index_dir, n_rows, model_name):
+    path = os.path.join(index_dir, INFO_FILE)
+    if not os.path.exists(path) or not all(has_text_store(index_dir, c) for c in COLUMNS):
+        return False
+    with open(path, "r", encoding="utf-8") as f:
+        info = json.load(f)
+    return (
+        info.get("rows") == n_rows
+        and info.get("max_display_chars") == MAX_DISPLAY_CHARS
+        and info.get("safety_fingerprint") == scanner.fingerprint
+        # counts left empty (no tokenizer at the time) are redone once one is available
+        and (info.get("tokenizer") == model_name
+             or (info.get("tokenizer") is None and not _tokenizer_available(model_name)))
+    )
+
+
+def load_derived(index_dir, texts, model_name: str = DEFAULT_LLM):
+    """
+    Opens the stored fields, or computes (and stores) them when missing or stale.
+    """
+    if _is_current(index_dir, len(texts), model_name):
+        return open_derived(index_dir)
+
+    print(f"[Derived] Computing per-document fields for {len(texts)} rows")
+    derived = compute_derived(list(texts), model_name)
+    try:
+        write_derived(index_dir, derived)
+        return open_derived(index_dir)
+    except OSError as e:
+        # read-only index dir: keep them in memory for this process
+        print(f"[Derived] Could not store fields in {index_dir} ({e})")
+        return derived
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute per-document derived fields for an index")
+    parser.add_argument("index_dir", nargs="?", default=INDEX_DIR)
+    args = parser.parse_args()
+    from loader import resolve_index_dir
+
+    index_dir = resolve_index_dir(args.index_dir)
+    if has_text_store(index_dir):
+        texts = list(TextStore(index_dir))
+    else:
+        with open(os.path.join(index_dir, "metadatas.pkl"), "rb") as f:
+            texts = pickle.load(f)["texts"]
+    write_derived(index_dir, compute_derived(texts))
+    print(f"[Derived] Wrote fields for {len(texts)} rows in {index_dir}")
@@ -0,0 +1,141 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+def normalize_query(text: str) -> str:
+    """
+    Cache key for a query: case and whitespace do not change the embedding enough to matter.
+    """
+    return " ".join(text.lower().split())
+
+
+class QueryEmbeddingCache:
+    """
+    Bounded LRU cache of query embeddings with optional TTL
+    and an optional SQLite tier that survives restarts. The SQLite tier is
+    pruned to the same TTL and size when it is opened.
+    """
+
+    def __init__(self, model_name: str, max_size: int = 2048, ttl: float = None, disk_path: str = None):
+        self.model_name = model_name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._entries = OrderedDict()  # key -> (created_at, vector)
+        self._lock = threading.Lock()
+        self._db = None
+
+        if disk_path:
+            os.makedirs(os.path.dirname(disk_path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings ("
+                "model TEXT, query TEXT, created_at REAL, vector BLOB, "
+                "PRIMARY KEY (model, query))"
+            )
+            self._prune()
+
+    def _prune(self):
+        """Drops expired rows, then all but the newest max_size rows of this model."""
+        if self.ttl is not None:
+            self._db.execute("DELETE FROM query_embeddings WHERE created_at < ?", (time.time() - self.ttl,))
+        self._db.execute(
+            "DELETE FROM query_embeddings WHERE model = ? AND query NOT IN ("
+            "SELECT query FROM query_embeddings WHERE model = ? ORDER BY created_at DESC LIMIT ?)",
+            (self.model_name, self.model_name, self.max_size),
+        )
+        self._db.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "disk_hits": self.disk_hits,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _expired(self, created_at):
+        return self.ttl is not None and time.time() - created_at > self.ttl
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            if not self._expired(entry[0]):
+                self._entries.move_to_end(key)
+                return entry[1]
+            del self._entries[key]
+
+        if self._db is not None:
+            row = self._db.execute(
+                "SELECT created_at, vector FROM query_embeddings WHERE model = ? AND query = ?",
+                (self.model_name, key),
+            ).fetchone()
+            if row is not None and not self._expired(row[0]):
+                vector = np.frombuffer(row[1], dtype="float32")
+                self._put_memory(key, vector, row[0])
+                self.disk_hits += 1
+                return vector
+        return None
+
+    def _put_memory(self, key, vector, created_at):
+        self._entries[key] = (created_at, vector)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _put(self, key, vector):
+        now = time.time()
+        self._put_memory(key, vector, now)
+        if self._db is not None:
+            self._db.execute(
+                "INSERT OR REPLACE INTO query_embeddings VALUES (?, ?, ?, ?)",
+                (self.model_name, key, now, vector.tobytes()),
+            )
+
+    def encode(self, queries, encode_fn):
+        """
+        Returns a float32 matrix of embeddings for `queries`.
+        Only cache misses are passed (as one batch) to `encode_fn`.
+        """
+        keys = [normalize_query(q) for q in queries]
+        vectors = [None] * len(keys)
+
+        missing = {}
+
+        with self._lock:
+            for i, key in enumerate(keys):
+                vectors[i] = self._get(key)
+                if vectors[i] is None:
+                    missing.setdefault(key, []).append(i)
+                    self.misses += 1
+                else:
+                    self.hits += 1
+
+        if missing:
+            # encode the original text of the first occurrence of each key
+            miss_keys = list(missing)
+            encoded = np.asarray(
+                encode_fn([queries[missing[key][0]] for key in miss_keys]), dtype="float32"
+            )
+            with self._lock:
+                for key, vector in zip(miss_keys, encoded):
+                    vector = vector.copy()
+                    self._put(key, vector)
+                    for i in missing[key]:
+                        vectors[i] = vector
+                if self._db is not None:
+                    self._db.commit()
+
+        return np.vstack(vectors).astype("float32")
@@ -0,0 +1,138 @@
+"""
+Query encoder backends.
+
+- torch      the SentenceTransformer model as published
+- onnx       the same weights exported to an ONNX graph (ONNX Runtime)
+- onnx_int8  that graph with dynamic int8 quantization, for CPU hosts
+
+All three produce vectors in the same space, so an index built with the
+original model keeps working. The parity check verifies it:
+
+    python encoder.py --backend onnx_int8 --limit 300
+"""
+import argparse
+import json
+import os
+import numpy as np
+from config import (
+    EMBEDDING_MODEL, DEVICE, ENCODER_BACKEND, ENCODER_EXPORT_DIR, ENCODER_INT8_CONFIG,
+    INDEX_DIR, DATASET_PATH,
+)
+
+BACKENDS = ("torch", "onnx", "onnx_int8")
+
+
+def resolve_device(device: str = DEVICE):
+    """The configured device, or "cpu" when CUDA is not available."""
+    if device.startswith("cuda"):
+        try:
+            import torch
+
+            if torch.cuda.is_available():
+                return device
+        except ImportError:
+            pass
+        print(f"[Encoder] {device} not available, using cpu")
+        return "cpu"
+    return device
+
+
+def _int8_export(model_name: str):
+    """
+    Exports and quantizes the model once; returns (local dir, onnx file name).
+    """
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+    export_dir = os.path.join(ENCODER_EXPORT_DIR, model_name.replace("/", "__"))
+    file_name = f"onnx/model_qint8_{ENCODER_INT8_CONFIG}.onnx"
+    if not os.path.exists(os.path.join(export_dir, file_name)):
+        print(f"[Encoder] Exporting int8 ONNX graph of {model_name} to {export_dir}")
+        model = SentenceTransformer(model_name, device="cpu", backend="onnx")
+        model.save(export_dir)
+        export_dynamic_quantized_onnx_model(model, ENCODER_INT8_CONFIG, export_dir)
+    return export_dir, file_name
+
+
+def load_encoder(model_name: str = EMBEDDING_MODEL, backend: str = ENCODER_BACKEND, device: str = DEVICE):
+    """
+    SentenceTransformer for `model_name` on the requested backend. Falls back
+    to CPU without CUDA, and to the torch backend when ONNX Runtime is missing.
+    """
+    from sentence_transformers import SentenceTransformer
+
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown encoder backend {backend!r}, expected one of {BACKENDS}")
+    device = resolve_device(device)
+
+    try:
+        if backend == "onnx":
+            return SentenceTransformer(model_name, device=device, backend="onnx")
+        if backend == "onnx_int8":
+            # int8 kernels are CPU kernels
+            export_dir, file_name = _int8_export(model_name)
+            return SentenceTransformer(
+                export_dir, device="cpu", backend="onnx", model_kwargs={"file_name": file_name}
+            )
+    except Exception as e:
+        # missing optimum / onnxruntime, or sentence-transformers < 3.2 (no backend argument)
+        print(f"[Encoder] {backend} backend unavailable ({e}), using torch")
+    return SentenceTransformer(model_name, device=device)
+
+
+def parity_check(index_dir=INDEX_DIR, model_name=EMBEDDING_MODEL, backend=ENCODER_BACKEND,
+                 queries=None, k=10, min_overlap=0.95):
+    """
+    Searches the index (built with the original model) with queries encoded
+    by the torch backend and by `backend`; reports the mean top-k overlap and
+    embedding cosine, and whether the overlap is at least `min_overlap`.
+    """
+    import faiss
+    from loader import resolve_index_dir
+
+    index = faiss.read_index(os.path.join(resolve_index_dir(index_dir), "index.faiss"))
+    reference = load_encoder(model_name, "torch")
+    candidate = load_encoder(model_name, backend)
+
+    def encode(model):
+        return model.encode(
+            queries, convert_to_numpy=True, normalize_embeddings=True
+        ).astype("float32")
+
+    ref_emb, cand_emb = encode(reference), encode(candidate)
+    _, ref_ids = index.search(ref_emb, k)
+    _, cand_ids = index.search(cand_emb, k)
+
+    overlap = float(np.mean([
+        len(set(r.tolist()) & set(c.tolist())) / k for r, c in zip(ref_ids, cand_ids)
+    ]))
+    cosine = np.sum(ref_emb * cand_emb, axis=1)
+    report = {
+        "backend": backend,
+        "queries": len(queries),
+        f"top{k}_overlap": overlap,
+        "top1_agreement": float(np.mean(ref_ids[:, 0] == cand_ids[:, 0])),
+        "cosine_mean": float(cosine.mean()),
+        "cosine_min": float(cosine.min()),
+        "passed": overlap >= min_overlap,
+    }
+    print(f"[Encoder] Parity {json.dumps(report)}")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that an encoder backend retrieves like the original model")
+    parser.add_argument("--backend", choices=BACKENDS, default="onnx_int8")
+    parser.add_argument("--index_dir", default=INDEX_DIR)
+    parser.add_argument("--dataset", default=DATASET_PATH)
+    parser.add_argument("--limit", type=int, default=300)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--min_overlap", type=float, default=0.95)
+    args = parser.parse_args()
+
+    with open(args.dataset, "r", encoding="utf-8") as f:
+        items = json.load(f)[:args.limit]
+    report = parity_check(
+        args.index_dir, EMBEDDING_MODEL, args.backend,
+        [it["instruction"] for it in items], args.k, args.min_overlap,
+    )
+    raise SystemExit(0 if report["passed"] else 1)
@@ -1,7 +1,14 @@
 from answer_service import answer_service
-from sentence_transformers import SentenceTransformer, util
+from retriever import retriever
+from config import ENCODE_BATCH_SIZE, TOP_K, EVAL_WORKERS, EVAL_CHECKPOINT, LLM_BATCHING
+from sentence_transformers import SentenceTransformer
 from rouge_score import rouge_scorer
-from bert_score import score as bert_score
+from bert_score import BERTScorer
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import threading
 import numpy as np
 from tqdm import tqdm
 
@@ -9,42 +16,175 @@ from tqdm import tqdm
 #   1) Evaluate whole pipeline on dataset
 # --------------------------
 
-def run_pipeline(gt_pairs, sample_size=None):
-    results = []
-    pairs = gt_pairs if sample_size is None else gt_pairs[:sample_size]
-
-    for item in tqdm(pairs, desc="Running pipeline evaluation"):
-        query = item["instruction"]
-        gt = item["response"]
-
-        out = answer_service.answer(query, use_llm=True)
+def item_id(item, position):
+    """Stable id for checkpointing: the dataset questionID, else the item's position."""
+    return item.get("questionID", position)
+
+
+def load_checkpoint(checkpoint_path):
+    """questionID -> result row for every item already finished in a JSONL checkpoint."""
+    done = {}
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        with open(checkpoint_path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # partially written last line after a crash
+                done[row["questionID"]] = row
+    return done
+
+
+def run_pipeline(gt_pairs, sample_size=None, batch_size=ENCODE_BATCH_SIZE, workers=EVAL_WORKERS, checkpoint_path=EVAL_CHECKPOINT):
+    """
+    Runs the pipeline over the eval set. Retrieval is batched and runs ahead
+    while a worker pool generates; each finished row is appended to the JSONL
+    checkpoint, and rerunning skips the questionIDs already in it.
+    Several workers need LLM_BATCHING, so their generations go through the
+    model's scheduler instead of calling model.generate concurrently.
+    """
+    if workers > 1 and not LLM_BATCHING:
+        # concurrent model.generate calls on one model share its decode buffers
+        print(f"[Eval] {workers} workers need LLM_BATCHING; generating with 1 worker")
+        workers = 1
 
-        results.append({
-            "query": query,
-            "gt": gt,
+    pairs = gt_pairs if sample_size is None else gt_pairs[:sample_size]
+    ids = [item_id(item, i) for i, item in enumerate(pairs)]
+
+    done = load_checkpoint(checkpoint_path)
+    todo = [(qid, item) for qid, item in zip(ids, pairs) if qid not in done]
+    results_by_id = {qid: done[qid] for qid in ids if qid in done}
+    lock = threading.Lock()
+
+    ckpt = None
+    if checkpoint_path:
+        needs_newline = False
+        if os.path.exists(checkpoint_path) and os.path.getsize(checkpoint_path) > 0:
+            with open(checkpoint_path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b"\n"
+        ckpt = open(checkpoint_path, "a", encoding="utf-8")
+        if needs_newline:
+            # terminate a line cut off by a crash so new rows start cleanly
+            ckpt.write("\n")
+
+    def run_one(qid, item, candidates):
+        # score the model itself: no cached or bypassed answers
+        out = answer_service.answer(
+            item["instruction"], use_llm=True, candidates=candidates, use_cache=False, allow_bypass=False
+        )
+        row = {
+            "questionID": qid,
+            "query": item["instruction"],
+            "gt": item["response"],
             "retrieved": out["retrieved_answer"],
             "llm": out["llm_answer"],
             "safety": out["safety"]["level"]
-        })
-
-    return results
+        }
+        with lock:
+            results_by_id[qid] = row
+            if ckpt is not None:
+                ckpt.write(json.dumps(row, ensure_ascii=False) + "\n")
+                ckpt.flush()
+        return row
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool, \
+                tqdm(total=len(pairs), initial=len(results_by_id), desc="Running pipeline evaluation") as pbar:
+            futures = []
+            for start in range(0, len(todo), batch_size):
+                batch = todo[start:start + batch_size]
+
+                # retrieval for this batch overlaps generation of the earlier ones
+                all_candidates = retriever.retrieve_many(
+                    [item["instruction"] for _, item in batch], TOP_K
+                )
+
+                for (qid, item), candidates in zip(batch, all_candidates):
+                    future = pool.submit(run_one, qid, item, candidates)
+                    future.add_done_callback(lambda _: pbar.update(1))
+                    futures.append(future)
+
+            for future in futures:
+                future.result()
+    finally:
+        if ckpt is not None:
+            ckpt.close()
+
+    return [results_by_id[qid] for qid in ids if qid in results_by_id]
 
 
 # --------------------------
 #   2) Similarity Scores
 # --------------------------
 
-embedder = SentenceTransformer("all-mpnet-base-v2")
+EVAL_EMBED_MODEL = "all-mpnet-base-v2"
+GT_EMBED_CACHE = "./cache/eval_gt_embeddings.npz"
+
+embedder = SentenceTransformer(EVAL_EMBED_MODEL)
 rouge = rouge_scorer.RougeScorer(['rougeL'], use_stemmer=True)
 
+# built once on first use instead of per bert_score() call
+_bert_scorer = None
+
+
+def get_bert_scorer():
+    global _bert_scorer
+    if _bert_scorer is None:
+        _bert_scorer = BERTScorer(lang="en")
+    return _bert_scorer
+
+
+def encode_normalized(texts, batch_size=ENCODE_BATCH_SIZE):
+    return embedder.encode(
+        list(texts), batch_size=batch_size, convert_to_numpy=True, normalize_embeddings=True
+    ).astype("float32")
+
+
+def encode_cached(texts, cache_path=GT_EMBED_CACHE):
+    """
+    Normalized embeddings for texts that repeat across runs (ground truths),
+    cached on disk by content hash.
+    """
+    keys = [
+        hashlib.sha1((EVAL_EMBED_MODEL + "\0" + t).encode("utf-8")).hexdigest()
+        for t in texts
+    ]
+    cached = {}
+    if os.path.exists(cache_path):
+        data = np.load(cache_path)
+        cached = dict(zip(data["keys"].tolist(), data["vectors"]))
+
+    missing = [i for i, key in enumerate(keys) if key not in cached]
+    if missing:
+        vectors = encode_normalized([texts[i] for i in missing])
+        for i, v in zip(missing, vectors):
+            cached[keys[i]] = v
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        np.savez(
+            cache_path,
+            keys=np.array(list(cached)),
+            vectors=np.vstack(list(cached.values())),
+        )
+
+    return np.vstack([cached[key] for key in keys])
+
+
+def pairwise_cosine(emb_a, emb_b):
+    """Row-wise cosine of two normalized embedding matrices."""
+    return (emb_a * emb_b).sum(axis=1)
+
+
 def metrics(a, b):
     # cosine similarity
-    emb_a = embedder.encode(a, convert_to_tensor=True)
-    emb_b = embedder.encode(b, convert_to_tensor=True)
-    cosine = float(util.pytorch_cos_sim(emb_a, emb_b))
+    emb = encode_normalized([a, b])
+    cosine = float(pairwise_cosine(emb[:1], emb[1:])[0])
 
     # bertscore
-    P, R, F = bert_score([a], [b], lang="en")
+    P, R, F = get_bert_scorer().score([a], [b])
     bert_f1 = float(F[0])
 
     # rouge-L
@@ -57,38 +197,46 @@ def metrics(a, b):
     }
 
 
+def batch_metrics(preds, refs, pred_emb, ref_emb, bert_f1):
+    """Per-metric means for aligned prediction/reference lists."""
+    cosine = pairwise_cosine(pred_emb, ref_emb)
+    rougeL = [rouge.score(a, b)["rougeL"].fmeasure for a, b in zip(preds, refs)]
+    return {
+        "cosine": float(np.mean(cosine)),
+        "bert_f1": float(np.mean(bert_f1)),
+        "rougeL": float(np.mean(rougeL)),
+    }
+
+
 # --------------------------
 #   3) Full evaluation
 # --------------------------
 
 def evaluate_pipeline(results):
-    llm_vs_gt = []
-    llm_vs_ret = []
     safety_stats = {}
-
     for r in results:
         s = r["safety"]
         safety_stats[s] = safety_stats.get(s, 0) + 1
 
-        llm_vs_gt.append(metrics(r["llm"], r["gt"]))
-        llm_vs_ret.append(metrics(r["llm"], r["retrieved"]))
+    llm = [r["llm"] for r in results]
+    gt = [r["gt"] for r in results]
+    ret = [r["retrieved"] for r in results]
+
+    # one encode pass per column; ground truths come from the disk cache
+    llm_emb = encode_normalized(llm)
+    gt_emb = encode_cached(gt)
+    ret_emb = encode_normalized(ret)
 
-    def avg(metric_list, key):
-        return float(sum(m[key] for m in metric_list) / len(metric_list))
+    # one BERTScore call covering both comparisons
+    n = len(results)
+    _, _, F = get_bert_scorer().score(llm + llm, gt + ret, batch_size=ENCODE_BATCH_SIZE)
+    F = F.numpy()
 
     report = {
-        "LLM_vs_GroundTruth": {
-            "cosine": avg(llm_vs_gt, "cosine"),
-            "bert_f1": avg(llm_vs_gt, "bert_f1"),
-            "rougeL": avg(llm_vs_gt, "rougeL"),
-        },
-        "LLM_vs_Retrieved": {
-            "cosine": avg(llm_vs_ret, "cosine"),
-            "bert_f1": avg(llm_vs_ret, "bert_f1"),
-            "rougeL": avg(llm_vs_ret, "rougeL"),
-        },
+        "LLM_vs_GroundTruth": batch_metrics(llm, gt, llm_emb, gt_emb, F[:n]),
+        "LLM_vs_Retrieved": batch_metrics(llm, ret, llm_emb, ret_emb, F[n:]),
         "safety": safety_stats,
-        "samples": len(results)
+        "samples": n
     }
 
     return report
@@ -0,0 +1,264 @@
+"""
+Dynamic batching for LLM generation.
+
+Concurrent callers submit prompts; a single worker thread drains the queue
+into padded batches (up to max_batch_size, waiting at most max_wait_ms for
+a batch to fill) and routes each output back to its caller's future.
+Requests are only batched with others that share the same sampling params.
+Queue depth and batch sizes are published through the profiler (gauges
+"<name>.queue_depth" / "<name>.batch_size", counters "<name>.batches" /
+"<name>.batched_requests"), so they show up in Prometheus and the app.
+"""
+import argparse
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import nullcontext
+from profiler import profiler
+
+_STOP = object()
+_WAKE = object()   # wakes an idle worker so a released scheduler can exit
+
+
+class GenerationScheduler:
+    def __init__(self, generate_batch, max_batch_size: int = 8, max_wait_ms: float = 20.0, name: str = "scheduler"):
+        """
+        generate_batch(prompts, max_new_tokens=..., temperature=...) -> list[str]
+        name prefixes the published metrics
+        """
+        self.generate_batch = generate_batch
+        self.name = name
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._queue = queue.Queue()
+        self._pending = []  # requests taken off the queue but not batched yet
+        self._thread = None
+        self._closed = False
+        self._released = False
+        self._stopping = False
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "requests": 0,
+            "batches": 0,
+            "batched_requests": 0,
+            "max_queue_depth": 0,
+            "errors": 0,
+        }
+
+    # -------------------------
+    # Public API
+    # -------------------------
+    def submit(self, prompt: str, max_new_tokens: int = 256, temperature: float = 0.2) -> Future:
+        if self._closed:
+            raise RuntimeError("GenerationScheduler is closed")
+        future = Future()
+        # queued before the worker check, so a released worker that is
+        # exiting either sees it or is restarted for it
+        self._queue.put((prompt, (max_new_tokens, temperature), future))
+        self._ensure_started()
+        depth = self.queue_depth()
+        with self._stats_lock:
+            self._stats["requests"] += 1
+            self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], depth)
+        profiler.gauge(f"{self.name}.queue_depth", depth)
+        return future
+
+    def generate(self, prompt: str, max_new_tokens: int = 256, temperature: float = 0.2, timeout: float = None) -> str:
+        """Blocking helper: submit and wait for the result."""
+        return self.submit(prompt, max_new_tokens, temperature).result(timeout=timeout)
+
+    def close(self):
+        """Stops the worker once already queued requests are served."""
+        self._closed = True
+        with self._start_lock:
+            if self._thread is not None:
+                self._queue.put(_STOP)
+
+    def release(self):
+        """
+        Lets the worker thread exit whenever the queue is empty, instead of
+        waiting for more work. Later submits still work (the worker restarts
+        on demand), but an unused scheduler holds no thread, so its model can
+        be freed once the last caller drops it.
+        """
+        self._released = True
+        self._queue.put(_WAKE)
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize() + len(self._pending)
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["queue_depth"] = self.queue_depth()
+        stats["avg_batch_size"] = (
+            stats["batched_requests"] / stats["batches"] if stats["batches"] else 0.0
+        )
+        return stats
+
+    # -------------------------
+    # Worker
+    # -------------------------
+    def _ensure_started(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="generation-scheduler", daemon=True)
+                self._thread.start()
+
+    def _next_batch(self):
+        """Blocks for the first request, then fills the batch until full or max_wait_ms passes."""
+        if not self._pending:
+            if self._stopping:
+                return None, None
+            if self._released:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    return None, None
+            else:
+                item = self._queue.get()
+            if item is _STOP or item is _WAKE:
+                return None, None
+            self._pending.append(item)
+
+        params = self._pending[0][1]
+        deadline = time.monotonic() + self.max_wait_ms / 1000.0
+        while True:
+            matching = sum(1 for r in self._pending if r[1] == params)
+            remaining = deadline - time.monotonic()
+            if matching >= self.max_batch_size or remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                self._stopping = True
+                break
+            if item is _WAKE:
+                continue
+            self._pending.append(item)
+
+        batch, rest = [], []
+        for r in self._pending:
+            if r[1] == params and len(batch) < self.max_batch_size:
+                batch.append(r)
+            else:
+                rest.append(r)
+        self._pending = rest
+        return params, batch
+
+    def _run(self):
+        while True:
+            params, batch = self._next_batch()
+            if batch is None:
+                with self._start_lock:
+                    if not self._stopping and not self._closed and self.queue_depth():
+                        continue  # queued while this worker was exiting
+                    self._thread = None
+                return
+            max_new_tokens, temperature = params
+            prompts = [r[0] for r in batch]
+            profiler.gauge(f"{self.name}.queue_depth", self.queue_depth())
+            profiler.gauge(f"{self.name}.batch_size", len(batch))
+            try:
+                outputs = self.generate_batch(prompts, max_new_tokens=max_new_tokens, temperature=temperature)
+                for (_, _, future), text in zip(batch, outputs):
+                    future.set_result(text)
+            except Exception as e:
+                with self._stats_lock:
+                    self._stats["errors"] += 1
+                for _, _, future in batch:
+                    future.set_exception(e)
+
+            with self._stats_lock:
+                self._stats["batches"] += 1
+                self._stats["batched_requests"] += len(batch)
+            profiler.count(f"{self.name}.batches")
+            profiler.count(f"{self.name}.batched_requests", len(batch))
+
+
+def make_batch_generate(model, tokenizer, top_p: float = 0.9, lock=None):
+    """
+    Padded batch generation for any HF causal LM (a tiny model on CPU works for tests).
+    `lock`, when given, is held around generate() so the batches share the
+    model with callers that generate on it directly.
+    """
+    import torch
+
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    def generate_batch(prompts, max_new_tokens: int = 256, temperature: float = 0.2):
+        # decoder-only models need left padding so every row ends at the same position
+        padding_side = tokenizer.padding_side
+        tokenizer.padding_side = "left"
+        try:
+            inputs = tokenizer(
+                prompts,
+                return_tensors="pt",
+                padding=True,
+                truncation=True
+            ).to(model.device)
+        finally:
+            tokenizer.padding_side = padding_side
+
+        with lock or nullcontext(), torch.no_grad():
+            out = model.generate(
+                input_ids=inputs["input_ids"],
+                attention_mask=inputs["attention_mask"],
+                max_new_tokens=max_new_tokens,
+                temperature=temperature,
+                do_sample=temperature > 0,
+                top_p=top_p,
+                pad_token_id=tokenizer.pad_token_id
+            )
+
+        prompt_len = inputs["input_ids"].shape[1]
+        return [
+            tokenizer.decode(row[prompt_len:], skip_special_tokens=True).strip()
+            for row in out
+        ]
+
+    return generate_batch
+
+
+def self_check(model_id: str = "sshleifer/tiny-gpt2", n_requests: int = 8, max_batch_size: int = 4):
+    """
+    Runs make_batch_generate + the scheduler on a small HF model on CPU:
+    concurrent greedy requests must be batched and return the same text as
+    generating each prompt on its own.
+    """
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_id)
+    model = AutoModelForCausalLM.from_pretrained(model_id).to("cpu").eval()
+    generate_batch = make_batch_generate(model, tokenizer, lock=threading.Lock())
+    prompts = [f"Question {i}: how do I sleep better?" for i in range(n_requests)]
+    expected = [generate_batch([p], max_new_tokens=8, temperature=0.0)[0] for p in prompts]
+
+    scheduler = GenerationScheduler(generate_batch, max_batch_size=max_batch_size, max_wait_ms=50.0, name="self_check")
+    futures = [scheduler.submit(p, max_new_tokens=8, temperature=0.0) for p in prompts]
+    outputs = [f.result(timeout=120) for f in futures]
+    scheduler.close()
+
+    stats = scheduler.stats()
+    print(f"[Scheduler] {model_id}: {stats['batches']} batches, avg size {stats['avg_batch_size']:.1f}")
+    mismatched = [i for i, (a, b) in enumerate(zip(outputs, expected)) if a != b]
+    if mismatched:
+        print(f"[Scheduler] {len(mismatched)}/{n_requests} batched outputs differ from unbatched: {mismatched}")
+    else:
+        print("[Scheduler] batched outputs match unbatched generation")
+    return stats["batches"] < n_requests and not mismatched
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check batched generation on a small HF model on CPU")
+    parser.add_argument("--model", default="sshleifer/tiny-gpt2")
+    parser.add_argument("--requests", type=int, default=8)
+    parser.add_argument("--max_batch_size", type=int, default=4)
+    args = parser.parse_args()
+    ok = self_check(args.model, args.requests, args.max_batch_size)
+    raise SystemExit(0 if ok else 1)
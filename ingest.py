@@ -0,0 +1,160 @@
+"""
+Incremental index updates keyed by content hash.
+
+    python ingest.py                      # sync INDEX_DIR with DATASET_PATH
+    python ingest.py --dataset new.json --index_dir ./faiss_index_pair_v1
+
+Every stored pair is identified by the SHA-1 of its pair text. Only pairs
+whose hash is new are embedded; pairs that disappeared (or changed, which
+is a removal + an addition) are dropped with remove_ids on an IndexIDMap2.
+FAISS ids are row numbers of the text store; a removed row keeps its slot
+as an empty text, so ids never shift and unchanged vectors are reused.
+
+Each run writes a complete new generation under the index directory and
+then switches to it:
+
+    <index_dir>/gen-000002/   index.faiss, text store, derived fields, hashes
+    <index_dir>/CURRENT       "gen-000002"
+
+The generation is written to a temporary directory and renamed, and CURRENT
+is replaced atomically, so readers always see a complete generation.
+"""
+import argparse
+import json
+import os
+import pickle
+import faiss
+import numpy as np
+from build_index import load_pairs, embed_texts
+from text_store import TextStore, MetadataTable, has_text_store, write_text_store, content_hash
+from derived_fields import compute_derived, write_derived
+from loader import current_generation, resolve_index_dir, read_index_info, new_generation_dir, publish_generation
+from config import DATASET_PATH, INDEX_DIR, EMBEDDING_MODEL
+
+HASHES_FILE = "content_hashes.json"
+
+
+def _read_rows(index_dir):
+    if has_text_store(index_dir):
+        return list(TextStore(index_dir)), list(MetadataTable(index_dir))
+    with open(os.path.join(index_dir, "metadatas.pkl"), "rb") as f:
+        meta = pickle.load(f)
+    return list(meta["texts"]), list(meta["metadatas"])
+
+
+def _as_id_map(index):
+    """
+    IndexIDMap2 over a flat inner-product index. A plain flat index is
+    converted once (vector i gets id i, i.e. its row).
+    """
+    if isinstance(index, faiss.IndexIDMap2):
+        return index
+    if not isinstance(index, faiss.IndexFlat):
+        raise ValueError(
+            f"Incremental ingest needs a flat index, found {type(index).__name__}; "
+            "rebuild with build_index.py --type flat"
+        )
+    vectors = index.reconstruct_n(0, index.ntotal)
+    id_map = faiss.IndexIDMap2(faiss.IndexFlatIP(index.d))
+    id_map.add_with_ids(vectors, np.arange(index.ntotal, dtype=np.int64))
+    return id_map
+
+
+def ingest(dataset_path=DATASET_PATH, index_dir=INDEX_DIR, embedder=None):
+    """
+    Brings the index in `index_dir` in line with the dataset, embedding only
+    new or changed pairs. Returns a summary dict.
+    """
+    source_dir = resolve_index_dir(index_dir)
+    # new pairs must be embedded with the model the index was built with
+    embed_model = read_index_info(index_dir).get("embed_model", EMBEDDING_MODEL)
+    old_texts, old_metadatas = _read_rows(source_dir)
+    index = _as_id_map(faiss.read_index(os.path.join(source_dir, "index.faiss")))
+
+    hashes_path = os.path.join(source_dir, HASHES_FILE)
+    if os.path.exists(hashes_path):
+        with open(hashes_path, "r", encoding="utf-8") as f:
+            old_hashes = json.load(f)
+    else:
+        old_hashes = [content_hash(t) if t else "" for t in old_texts]
+
+    # hash -> rows holding it (a pair can appear more than once)
+    free_rows = {}
+    for row, h in enumerate(old_hashes):
+        if h:
+            free_rows.setdefault(h, []).append(row)
+
+    new_texts, new_metadatas = load_pairs(dataset_path)
+    texts = ["" if not h else t for t, h in zip(old_texts, old_hashes)]
+    metadatas = [{} for _ in texts]
+    hashes = list(old_hashes)
+
+    added_rows = []
+    for text, metadata in zip(new_texts, new_metadatas):
+        h = content_hash(text)
+        if free_rows.get(h):
+            row = free_rows[h].pop(0)   # unchanged: keep its row and vector
+        else:
+            row = len(texts)
+            texts.append(text)
+            metadatas.append({})
+            hashes.append(h)
+            added_rows.append(row)
+        metadatas[row] = metadata
+
+    removed_rows = sorted(row for rows in free_rows.values() for row in rows)
+    for row in removed_rows:
+        texts[row], metadatas[row], hashes[row] = "", {}, ""
+
+    if removed_rows:
+        index.remove_ids(np.asarray(removed_rows, dtype=np.int64))
+    if added_rows:
+        if embedder is None:
+            from encoder import load_encoder
+
+            embedder = load_encoder(embed_model, backend="torch")
+        print(f"[Ingest] Embedding {len(added_rows)} new or changed pairs")
+        embs = embed_texts(embedder, [texts[row] for row in added_rows])
+        index.add_with_ids(embs, np.asarray(added_rows, dtype=np.int64))
+
+    summary = {
+        "added": len(added_rows),
+        "removed": len(removed_rows),
+        "unchanged": len(new_texts) - len(added_rows),
+        "vectors": int(index.ntotal),
+    }
+    # metadata alone (e.g. dataset positions) can change too; that needs no embedding
+    if not added_rows and not removed_rows and metadatas == old_metadatas:
+        print(f"[Ingest] {index_dir} is up to date ({summary['vectors']} vectors)")
+        summary["generation"] = current_generation(index_dir)
+        return summary
+
+    # write the whole generation aside, then rename it into place and switch
+    generation, tmp_dir = new_generation_dir(index_dir)
+    faiss.write_index(index, os.path.join(tmp_dir, "index.faiss"))
+    write_text_store(tmp_dir, texts, metadatas)
+    write_derived(tmp_dir, compute_derived(texts))
+    with open(os.path.join(tmp_dir, HASHES_FILE), "w", encoding="utf-8") as f:
+        json.dump(hashes, f)
+    with open(os.path.join(tmp_dir, "index_info.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "index_type": "flat",
+            "embed_model": embed_model,
+            "n_items": int(index.ntotal),
+            "generation": generation,
+            "source": dataset_path,
+            **{k: summary[k] for k in ("added", "removed", "unchanged")},
+        }, f, ensure_ascii=False, indent=2)
+    publish_generation(index_dir, generation)
+
+    summary["generation"] = generation
+    print(f"[Ingest] {generation}: {json.dumps(summary)}")
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Incrementally update the index from the dataset")
+    parser.add_argument("--dataset", default=DATASET_PATH)
+    parser.add_argument("--index_dir", default=INDEX_DIR)
+    args = parser.parse_args()
+    ingest(args.dataset, args.index_dir)
@@ -0,0 +1,139 @@
+"""
+In-process BM25 index over the pair texts, and fusion with dense results.
+
+The inverted index is stored CSR-style in a few flat numpy arrays:
+- indptr   int64, n_terms + 1   postings of term t are [indptr[t], indptr[t + 1])
+- doc_ids  int32                document (row) of each posting, ascending per term
+- tfs      float32              term frequency of each posting
+- doc_len  float32, n_docs      tokens per document
+
+Rows emptied by an incremental ingest have no postings, so they never match.
+Scoring a query touches only the postings of its terms.
+"""
+import re
+import numpy as np
+from config import BM25_K1, BM25_B, RRF_K
+
+_TOKEN = re.compile(r"\w+")
+
+# function words carry no signal for BM25 and have the longest postings
+STOPWORDS = frozenset("""
+a about after again all also am an and any are as at be because been before being
+but by can could did do does doing don for from had has have having he her here
+hers him his how i if in into is it its itself just me more most my myself no nor
+not of off on once only or other our ours out over own same she should so some
+such than that the their theirs them then there these they this those through to
+too under until up very was we were what when where which while who whom why will
+with would you your yours yourself instruction response
+""".split())
+
+
+def tokenize(text: str):
+    return [t for t in _TOKEN.findall(text.lower()) if t not in STOPWORDS]
+
+
+class BM25Index:
+    def __init__(self, vocab, indptr, doc_ids, tfs, doc_len, k1: float = BM25_K1, b: float = BM25_B):
+        self.vocab = vocab
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_len = doc_len
+        self.k1 = k1
+        self.b = b
+
+        n_docs = int(np.count_nonzero(doc_len))
+        df = np.diff(indptr).astype("float32")
+        self.idf = np.log1p((n_docs - df + 0.5) / (df + 0.5)).astype("float32")
+        avg_len = float(doc_len[doc_len > 0].mean()) if n_docs else 1.0
+        # per-document part of the BM25 denominator, computed once
+        self.norm = (k1 * (1 - b + b * doc_len / avg_len)).astype("float32")
+
+    @classmethod
+    def build(cls, texts, **kwargs):
+        vocab = {}
+        term_ids, docs, counts = [], [], []
+        doc_len = np.zeros(len(texts), dtype="float32")
+        for row, text in enumerate(texts):
+            tokens = tokenize(text) if text else []
+            doc_len[row] = len(tokens)
+            tf = {}
+            for token in tokens:
+                tf[token] = tf.get(token, 0) + 1
+            for token, n in tf.items():
+                term_ids.append(vocab.setdefault(token, len(vocab)))
+                docs.append(row)
+                counts.append(n)
+
+        term_ids = np.asarray(term_ids, dtype="int64")
+        # stable sort keeps doc ids ascending within each term
+        order = np.argsort(term_ids, kind="stable")
+        indptr = np.zeros(len(vocab) + 1, dtype="int64")
+        np.cumsum(np.bincount(term_ids, minlength=len(vocab)), out=indptr[1:])
+        return cls(
+            vocab,
+            indptr,
+            np.asarray(docs, dtype="int32")[order],
+            np.asarray(counts, dtype="float32")[order],
+            doc_len,
+            **kwargs,
+        )
+
+    def __len__(self):
+        return len(self.doc_len)
+
+    def scores(self, query: str):
+        """Dense BM25 score vector over all documents."""
+        scores = np.zeros(len(self.doc_len), dtype="float32")
+        for token in set(tokenize(query)):
+            t = self.vocab.get(token)
+            if t is None:
+                continue
+            start, end = self.indptr[t], self.indptr[t + 1]
+            docs, tf = self.doc_ids[start:end], self.tfs[start:end]
+            # doc ids are unique within a term, so fancy-index += is safe
+            scores[docs] += self.idf[t] * tf * (self.k1 + 1) / (tf + self.norm[docs])
+        return scores
+
+    def search(self, query: str, k: int):
+        """(scores, ids) of the top-k matching documents, best first."""
+        scores = self.scores(query)
+        matched = np.flatnonzero(scores)
+        if len(matched) > k:
+            matched = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        ids = matched[np.argsort(-scores[matched], kind="stable")]
+        return scores[ids], ids
+
+
+def rrf_fuse(rankings, k: int, rrf_k: int = RRF_K):
+    """
+    Reciprocal rank fusion of ranked id lists: sum of 1 / (rrf_k + rank).
+    Returns (fused scores, ids) of the top k.
+    """
+    fused = {}
+    for ranking in rankings:
+        for rank, idx in enumerate(ranking, start=1):
+            fused[idx] = fused.get(idx, 0.0) + 1.0 / (rrf_k + rank)
+    top = sorted(fused.items(), key=lambda item: -item[1])[:k]
+    return [s for _, s in top], [i for i, _ in top]
+
+
+def weighted_fuse(dense, lexical, k: int, dense_weight: float):
+    """
+    Weighted sum of min-max normalized dense and BM25 scores, each given as
+    {id: score}; an id missing from one list scores 0 there.
+    """
+    def normalized(scores):
+        if not scores:
+            return {}
+        lo, hi = min(scores.values()), max(scores.values())
+        span = (hi - lo) or 1.0
+        return {i: (s - lo) / span for i, s in scores.items()}
+
+    dense, lexical = normalized(dense), normalized(lexical)
+    fused = {
+        i: dense_weight * dense.get(i, 0.0) + (1 - dense_weight) * lexical.get(i, 0.0)
+        for i in dense.keys() | lexical.keys()
+    }
+    top = sorted(fused.items(), key=lambda item: -item[1])[:k]
+    return [s for _, s in top], [i for i, _ in top]
@@ -1,45 +1,275 @@
 from unsloth import FastLanguageModel
-from transformers import TextStreamer
+from transformers import TextIteratorStreamer, DynamicCache
+from transformers.generation.streamers import BaseStreamer
+import asyncio
+import copy
+import threading
+import time
 import torch
+from generation_scheduler import GenerationScheduler, make_batch_generate
+from model_registry import ModelRegistry
+from profiler import profiler
+from config import (
+    LLM_MODELS, DEFAULT_LLM, LLM_MAX_RESIDENT, LLM_MEMORY_BUDGET_GB,
+    LLM_MAX_BATCH_SIZE, LLM_MAX_WAIT_MS, LLM_MAX_SEQ_LENGTH,
+)
 
-MODEL_ID = "unsloth/Llama-3.2-3B-Instruct"
-MAX_SEQ_LENGTH = 2048
+MAX_SEQ_LENGTH = LLM_MAX_SEQ_LENGTH
 DTYPE = None
 LOAD_IN_4BIT = True
+# reuse the KV state of static prompt prefixes; off until verified per model
+# with `python llm_rephrase.py` (TTFT + greedy output parity)
+USE_PREFIX_CACHE = False
+
+
+class LLMHandle:
+    """
+    A loaded model + tokenizer and the per-model state built on top of it
+    (prefix KV caches, batching scheduler).
+
+    Every forward pass on the model (batched, direct or streamed) holds
+    generate_lock, so concurrent callers never run the model at the same time.
+    """
+
+    def __init__(self, name: str, model_id: str):
+        self.name = name
+        self.model_id = model_id
+
+        # Load model + tokenizer
+        self.model, self.tokenizer = FastLanguageModel.from_pretrained(
+            model_name = model_id,
+            max_seq_length = MAX_SEQ_LENGTH,
+            dtype = DTYPE,
+            load_in_4bit = LOAD_IN_4BIT,
+        )
+        FastLanguageModel.for_inference(self.model)
+        self.footprint_gb = self.model.get_memory_footprint() / 1024 ** 3
+
+        # prefix text -> (prefix input_ids, prefilled KV cache)
+        self.prefix_cache = {}
+        self.prefix_lock = threading.Lock()
+        self.generate_lock = threading.Lock()
+
+        # Padded batch generation + a scheduler that feeds it from concurrent callers
+        self.scheduler = GenerationScheduler(
+            make_batch_generate(self.model, self.tokenizer, lock=self.generate_lock),
+            max_batch_size=LLM_MAX_BATCH_SIZE,
+            max_wait_ms=LLM_MAX_WAIT_MS,
+            name=f"llm_scheduler.{name}",
+        )
+
+    def close(self):
+        # called on eviction: callers may still hold this handle, so the
+        # scheduler keeps accepting work and only stops idling on a thread
+        self.scheduler.release()
+        self.prefix_cache.clear()
+
 
-# Load model + tokenizer
-model, tokenizer = FastLanguageModel.from_pretrained(
-    model_name = MODEL_ID,
-    max_seq_length = MAX_SEQ_LENGTH,
-    dtype = DTYPE,
-    load_in_4bit = LOAD_IN_4BIT,
+registry = ModelRegistry(
+    LLM_MODELS,
+    load_fn=lambda name, spec: LLMHandle(name, spec["model_id"]),
+    max_resident=LLM_MAX_RESIDENT,
+    memory_budget_gb=LLM_MEMORY_BUDGET_GB,
 )
-FastLanguageModel.for_inference(model)
-
-def generate_llm_answer(prompt: str, max_new_tokens: int = 256, temperature: float = 0.2):
-    """Generate text from Llama using unsloth in a clean reusable form."""
-
-    inputs = tokenizer(
-        prompt,
-        return_tensors="pt",
-        padding=True,
-        truncation=True
-    ).to(model.device)
-
-    with torch.no_grad():
-        out = model.generate(
-            input_ids=inputs["input_ids"],
-            attention_mask=inputs["attention_mask"],
+
+
+class _FirstTokenTimer(BaseStreamer):
+    """Timestamps the first generated token to split prefill from decode."""
+
+    def __init__(self):
+        self.calls = 0
+        self.first_token_at = None
+
+    def put(self, value):
+        # generate() first puts the prompt ids, then one token per step
+        self.calls += 1
+        if self.calls == 2:
+            self.first_token_at = time.perf_counter()
+
+    def end(self):
+        pass
+
+
+def _record_generation(t0, first_token_at, t_end):
+    if first_token_at is None:
+        profiler.record("prefill", (t_end - t0) * 1000)
+        return
+    profiler.record("prefill", (first_token_at - t0) * 1000)
+    profiler.record("decode", (t_end - first_token_at) * 1000)
+
+
+def get_llm(model_name: str = None) -> LLMHandle:
+    """Loaded handle for a registered model name (DEFAULT_LLM when None)."""
+    return registry.get(model_name or DEFAULT_LLM)
+
+
+def _prefix_state(llm: LLMHandle, prefix: str):
+    """Tokenizes and prefills a static prompt prefix once per model."""
+    with llm.prefix_lock:
+        if prefix not in llm.prefix_cache:
+            prefix_ids = llm.tokenizer(prefix, return_tensors="pt").input_ids.to(llm.model.device)
+            with profiler.span("prefix_prefill"), llm.generate_lock, torch.no_grad():
+                kv = llm.model(
+                    input_ids=prefix_ids,
+                    past_key_values=DynamicCache(),
+                    use_cache=True,
+                ).past_key_values
+            llm.prefix_cache[prefix] = (prefix_ids, kv)
+        return llm.prefix_cache[prefix]
+
+
+def _build_inputs(llm: LLMHandle, prompt: str, prefix: str = None, use_prefix_cache: bool = USE_PREFIX_CACHE):
+    """
+    Returns generate() kwargs for the prompt. When the prompt starts with a
+    cached prefix only the remaining tokens are prefilled.
+    """
+    if use_prefix_cache and prefix and prompt.startswith(prefix):
+        prefix_ids, kv = _prefix_state(llm, prefix)
+        with profiler.span("tokenize"):
+            suffix_ids = llm.tokenizer(
+                prompt[len(prefix):], return_tensors="pt", add_special_tokens=False
+            ).input_ids.to(llm.model.device)
+        input_ids = torch.cat([prefix_ids, suffix_ids], dim=1)
+        if input_ids.shape[1] <= MAX_SEQ_LENGTH:
+            return {
+                "input_ids": input_ids,
+                "attention_mask": torch.ones_like(input_ids),
+                # generate() extends the cache in place, so each call gets a copy
+                "past_key_values": copy.deepcopy(kv),
+            }
+
+    with profiler.span("tokenize"):
+        inputs = llm.tokenizer(
+            prompt,
+            return_tensors="pt",
+            padding=True,
+            truncation=True
+        ).to(llm.model.device)
+    return {"input_ids": inputs["input_ids"], "attention_mask": inputs["attention_mask"]}
+
+
+def generate_llm_answer(prompt: str, max_new_tokens: int = 256, temperature: float = 0.2, prefix: str = None, use_prefix_cache: bool = USE_PREFIX_CACHE, model_name: str = None):
+    """Generate text from the selected model using unsloth in a clean reusable form."""
+
+    llm = get_llm(model_name)
+    inputs = _build_inputs(llm, prompt, prefix, use_prefix_cache)
+
+    timer = _FirstTokenTimer() if profiler.current() is not None else None
+    t0 = time.perf_counter()
+    with llm.generate_lock, torch.no_grad():
+        out = llm.model.generate(
+            **inputs,
+            streamer=timer,
             max_new_tokens=max_new_tokens,
             temperature=temperature,
             do_sample=True,
             top_p=0.9,
-            pad_token_id=tokenizer.eos_token_id
+            pad_token_id=llm.tokenizer.eos_token_id
         )
+    if timer is not None:
+        _record_generation(t0, timer.first_token_at, time.perf_counter())
 
     # Extract generated-only part
     prompt_len = inputs["input_ids"].shape[1]
     generated_tokens = out[0][prompt_len:]
-    generated_only = tokenizer.decode(generated_tokens, skip_special_tokens=True)
+    generated_only = llm.tokenizer.decode(generated_tokens, skip_special_tokens=True)
 
     return generated_only.strip()
+
+
+def stream_llm_answer(prompt: str, max_new_tokens: int = 256, temperature: float = 0.2, prefix: str = None, use_prefix_cache: bool = USE_PREFIX_CACHE, model_name: str = None):
+    """Same as generate_llm_answer, but yields decoded text chunks as they are generated."""
+
+    llm = get_llm(model_name)
+    inputs = _build_inputs(llm, prompt, prefix, use_prefix_cache)
+    streamer = TextIteratorStreamer(llm.tokenizer, skip_prompt=True, skip_special_tokens=True)
+    errors = []
+
+    def _generate():
+        try:
+            # held for the whole stream: batched and other streamed
+            # generations on this model wait for it to finish
+            with llm.generate_lock, torch.no_grad():
+                llm.model.generate(
+                    **inputs,
+                    streamer=streamer,
+                    max_new_tokens=max_new_tokens,
+                    temperature=temperature,
+                    do_sample=True,
+                    top_p=0.9,
+                    pad_token_id=llm.tokenizer.eos_token_id
+                )
+        except Exception as e:
+            errors.append(e)
+            streamer.end()  # unblock the consumer
+
+    thread = threading.Thread(target=_generate, daemon=True)
+    t0 = time.perf_counter()
+    first_token_at = None
+    thread.start()
+    for chunk in streamer:
+        if chunk:
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+            yield chunk
+    thread.join()
+    _record_generation(t0, first_token_at, time.perf_counter())
+    if errors:
+        raise errors[0]
+
+
+def generate_llm_answer_batched(prompt: str, max_new_tokens: int = 256, temperature: float = 0.2, model_name: str = None):
+    """Queues the prompt on the model's scheduler, batched with concurrent requests."""
+    scheduler = get_llm(model_name).scheduler
+    # queue wait + batched prefill/decode, not separable per request
+    with profiler.span("generate_batched"):
+        return scheduler.generate(
+            prompt, max_new_tokens=max_new_tokens, temperature=temperature
+        )
+
+
+async def agenerate_llm_answer(prompt: str, max_new_tokens: int = 256, temperature: float = 0.2, model_name: str = None):
+    """
+    Awaitable generation: the prompt is queued on the model's scheduler, so
+    concurrent coroutines are batched together without blocking the event loop.
+    """
+    # a first call may load the model
+    llm = await asyncio.to_thread(get_llm, model_name)
+    with profiler.span("generate_batched"):
+        return await asyncio.wrap_future(
+            llm.scheduler.submit(prompt, max_new_tokens=max_new_tokens, temperature=temperature)
+        )
+
+
+def time_to_first_token(prompt: str, prefix: str = None, use_prefix_cache: bool = USE_PREFIX_CACHE, model_name: str = None):
+    """Seconds from prompt to the first generated token (prefill cost)."""
+    llm = get_llm(model_name)
+    if use_prefix_cache and prefix:
+        _prefix_state(llm, prefix)  # building the cache is a one-off, keep it out of the timing
+
+    t0 = time.perf_counter()
+    inputs = _build_inputs(llm, prompt, prefix, use_prefix_cache)
+    with llm.generate_lock, torch.no_grad():
+        llm.model.generate(
+            **inputs,
+            max_new_tokens=1,
+            do_sample=False,
+            pad_token_id=llm.tokenizer.eos_token_id
+        )
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return time.perf_counter() - t0
+
+
+def greedy_tokens(prompt: str, n: int = 8, prefix: str = None, use_prefix_cache: bool = USE_PREFIX_CACHE, model_name: str = None):
+    """First `n` greedily generated token ids, to compare the two prefill paths."""
+    llm = get_llm(model_name)
+    inputs = _build_inputs(llm, prompt, prefix, use_prefix_cache)
+    with llm.generate_lock, torch.no_grad():
+        out = llm.model.generate(
+            **inputs,
+            max_new_tokens=n,
+            do_sample=False,
+            pad_token_id=llm.tokenizer.eos_token_id
+        )
+    return out[0][inputs["input_ids"].shape[1]:].tolist()
@@ -1,7 +1,14 @@
-from llm_client_unsloth import generate_llm_answer
+import asyncio
+import importlib
+from config import LLM_BATCHING
+from profiler import profiler
+from startup import Lazy
 
-def build_rephrase_prompt(query: str, retrieved_answer: str):
-    return f"""
+# importing unsloth/torch takes seconds; deferred to the first generation
+llm_client = Lazy("llm_client", lambda: importlib.import_module("llm_client_unsloth"))
+
+# Static instructions shared by every rephrase prompt; its KV state is cached once per model.
+REPHRASE_PREFIX = """
 SYSTEM PROMPT:
 You are a careful, empathetic mental health assistant.
 
@@ -46,7 +53,10 @@ INSTRUCTIONS:
 - No emojis.
 
 USER QUESTION:
-{query}
+"""
+
+def build_rephrase_prompt(query: str, retrieved_answer: str):
+    return REPHRASE_PREFIX + f"""{query}
 
 RETRIEVED ANSWER:
 {retrieved_answer}
@@ -56,7 +66,102 @@ FINAL RESPONSE:
 
 """
 
-def rephrase_answer(query: str, retrieved_answer: str, max_new_tokens: int = 256, temperature: float = 0.25, top_p: float = 0.9, system_prompt: str = None, enable_safety_prompt: bool = True):
+def rephrase_answer(query: str, retrieved_answer: str, max_new_tokens: int = 256, temperature: float = 0.25, top_p: float = 0.9, system_prompt: str = None, enable_safety_prompt: bool = True, model: str = None):
     # optional system_prompt and safety are handled by caller; keep interface flexible
-    prompt = build_rephrase_prompt(query, retrieved_answer)
-    return generate_llm_answer(prompt, max_new_tokens=max_new_tokens, temperature=temperature)
+    with profiler.span("prompt"):
+        prompt = build_rephrase_prompt(query, retrieved_answer)
+    if LLM_BATCHING:
+        # queued and batched with concurrent requests
+        return llm_client.generate_llm_answer_batched(prompt, max_new_tokens=max_new_tokens, temperature=temperature, model_name=model)
+    return llm_client.generate_llm_answer(prompt, max_new_tokens=max_new_tokens, temperature=temperature, prefix=REPHRASE_PREFIX, model_name=model)
+
+def stream_rephrase_answer(query: str, retrieved_answer: str, max_new_tokens: int = 256, temperature: float = 0.25, top_p: float = 0.9, system_prompt: str = None, enable_safety_prompt: bool = True, model: str = None):
+    """Generator version of rephrase_answer, yields text chunks as they are generated."""
+    with profiler.span("prompt"):
+        prompt = build_rephrase_prompt(query, retrieved_answer)
+    stream = llm_client.stream_llm_answer(prompt, max_new_tokens=max_new_tokens, temperature=temperature, prefix=REPHRASE_PREFIX, model_name=model)
+    # the stream is consumed after answer() returns; keep timing into the same request
+    return profiler.iter_with(stream, profiler.current())
+
+
+async def arephrase_answer(query: str, retrieved_answer: str, max_new_tokens: int = 256, temperature: float = 0.25, top_p: float = 0.9, system_prompt: str = None, enable_safety_prompt: bool = True, model: str = None):
+    """Coroutine version of rephrase_answer; always goes through the batching scheduler."""
+    with profiler.span("prompt"):
+        prompt = build_rephrase_prompt(query, retrieved_answer)
+    client = await asyncio.to_thread(llm_client.get)
+    return await client.agenerate_llm_answer(prompt, max_new_tokens=max_new_tokens, temperature=temperature, model_name=model)
+
+def astream_rephrase_answer(query: str, retrieved_answer: str, max_new_tokens: int = 256, temperature: float = 0.25, top_p: float = 0.9, system_prompt: str = None, enable_safety_prompt: bool = True, model: str = None):
+    """
+    Async generator version of stream_rephrase_answer; loading the client and
+    each chunk are awaited off the event loop. Like the sync stream, it holds
+    the model's generate lock, so it takes turns with the batching scheduler.
+    """
+    # consumed after answer() returns; keep timing into the calling request
+    return _astream_rephrase(profiler.current(), query, retrieved_answer, max_new_tokens, temperature, model)
+
+async def _astream_rephrase(timings, query, retrieved_answer, max_new_tokens, temperature, model):
+    # first use imports unsloth, which must not block the event loop
+    client = await asyncio.to_thread(llm_client.get)
+
+    def stream():
+        with profiler.span("prompt"):
+            prompt = build_rephrase_prompt(query, retrieved_answer)
+        yield from client.stream_llm_answer(prompt, max_new_tokens=max_new_tokens, temperature=temperature, prefix=REPHRASE_PREFIX, model_name=model)
+
+    async for chunk in _aiter_in_thread(profiler.iter_with(stream(), timings)):
+        yield chunk
+
+async def _aiter_in_thread(iterator):
+    done = object()
+    while True:
+        chunk = await asyncio.to_thread(next, iterator, done)
+        if chunk is done:
+            return
+        yield chunk
+
+def report_prefix_cache_ttft(samples: int = 10, dataset_path: str = "cleaned_dataset.json", model: str = None):
+    """
+    Time-to-first-token for rephrase prompts with and without the prefix KV
+    cache, and whether both paths generate the same greedy tokens. One
+    warm-up run per mode comes first, and the order of the two modes
+    alternates per prompt, so warm-up effects do not favour either side.
+    """
+    import json
+    import statistics
+
+    with open(dataset_path, "r", encoding="utf-8") as f:
+        items = json.load(f)[:samples]
+    prompts = [build_rephrase_prompt(it["instruction"], it["response"][:1500]) for it in items]
+
+    def ttft(prompt, use_cache):
+        return llm_client.time_to_first_token(prompt, prefix=REPHRASE_PREFIX, use_prefix_cache=use_cache, model_name=model)
+
+    for use_cache in (False, True):
+        ttft(prompts[0], use_cache)
+
+    times = {False: [], True: []}
+    for i, prompt in enumerate(prompts):
+        for use_cache in ((False, True) if i % 2 == 0 else (True, False)):
+            times[use_cache].append(ttft(prompt, use_cache))
+
+    matches = [
+        llm_client.greedy_tokens(p, prefix=REPHRASE_PREFIX, use_prefix_cache=False, model_name=model)
+        == llm_client.greedy_tokens(p, prefix=REPHRASE_PREFIX, use_prefix_cache=True, model_name=model)
+        for p in prompts
+    ]
+
+    report = {}
+    for label, use_cache in (("without_prefix_cache", False), ("with_prefix_cache", True)):
+        report[label] = {
+            "mean_s": statistics.mean(times[use_cache]),
+            "p50_s": statistics.median(times[use_cache]),
+        }
+    report["speedup_p50"] = report["without_prefix_cache"]["p50_s"] / report["with_prefix_cache"]["p50_s"]
+    report["greedy_outputs_match"] = sum(matches) / len(matches)
+    print(f"[TTFT] {json.dumps(report)}")
+    return report
+
+
+if __name__ == "__main__":
+    report_prefix_cache_ttft()
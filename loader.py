@@ -1,34 +1,199 @@
+import json
 import os
 import pickle
+import shutil
+import threading
 import faiss
-from sentence_transformers import SentenceTransformer
-from config import INDEX_DIR, EMBEDDING_MODEL, DEVICE
+from startup import Lazy
+from text_store import TextStore, MetadataTable, has_text_store
+from derived_fields import load_derived
+from lexical_index import BM25Index
+from config import INDEX_DIR, EMBEDDING_MODEL, ENCODER_BACKEND, INDEX_MMAP, INDEX_TYPE, INDEX_PARAMS
+
+SEARCH_PARAMS = ("nprobe", "efSearch")
+CURRENT_FILE = "CURRENT"   # names the active generation of a versioned index dir (see ingest.py)
+GENERATION_PREFIX = "gen-"
+
+
+def mmap_io_flags():
+    """
+    FAISS read flags for a read-only, memory-mapped index.
+    Processes mapping the same file share the OS page cache.
+    """
+    flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+    # zero-copy mapping of flat codes (newer FAISS builds only)
+    flags |= getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+    return flags
+
+
+def apply_search_params(index, params):
+    """
+    Applies search-time knobs (IVF nprobe, HNSW efSearch) from an INDEX_PARAMS entry.
+    """
+    space = faiss.ParameterSpace()
+    for name in SEARCH_PARAMS:
+        if name in params:
+            space.set_index_parameter(index, name, params[name])
+    return index
+
+
+def current_generation(index_dir):
+    """Name of the active generation, or None for a plain (unversioned) index dir."""
+    try:
+        with open(os.path.join(index_dir, CURRENT_FILE), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def resolve_index_dir(index_dir):
+    """Directory holding the files of the active generation."""
+    generation = current_generation(index_dir)
+    return os.path.join(index_dir, generation) if generation else index_dir
+
+
+def read_index_info(index_dir):
+    """index_info.json of the active generation ({} for indexes built without one)."""
+    path = os.path.join(resolve_index_dir(index_dir), "index_info.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def switch_generation(index_dir, generation):
+    """Atomically points CURRENT at `generation`."""
+    tmp_path = os.path.join(index_dir, CURRENT_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(generation)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(index_dir, CURRENT_FILE))
+
+
+def next_generation(index_dir):
+    numbers = [
+        int(name[len(GENERATION_PREFIX):])
+        for name in os.listdir(index_dir)
+        if name.startswith(GENERATION_PREFIX) and name[len(GENERATION_PREFIX):].isdigit()
+    ]
+    return f"{GENERATION_PREFIX}{max(numbers, default=0) + 1:06d}"
+
+
+def new_generation_dir(index_dir):
+    """
+    (name, empty temporary directory) for the next generation of `index_dir`.
+    Write every file into it, then call publish_generation().
+    """
+    generation = next_generation(index_dir)
+    tmp_dir = os.path.join(index_dir, generation + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    return generation, tmp_dir
+
+
+def publish_generation(index_dir, generation):
+    """Renames the written generation into place and switches CURRENT to it."""
+    os.rename(os.path.join(index_dir, generation + ".tmp"), os.path.join(index_dir, generation))
+    switch_generation(index_dir, generation)
+
 
 class PairIndexLoader:
-    def __init__(self):
-        self.index = None
+    def __init__(self, index_dir=INDEX_DIR, mmap=INDEX_MMAP, index_type=INDEX_TYPE, embedding_model=EMBEDDING_MODEL,
+                 encoder_backend=ENCODER_BACKEND):
+        # a versioned root (with CURRENT) resolves to its active generation on load()
+        self.index_root = index_dir
+        self.index_dir = index_dir
+        self.mmap = mmap
+        self.index_type = index_type
+        self.embedding_model = embedding_model
+        self.encoder_backend = encoder_backend
         self.texts = None
         self.meta = None
+        self.derived = None
         self.embedder = None
+        self._index = None
+        self._index_lock = threading.Lock()
+        self._lexical = None
+
+    @property
+    def index_path(self):
+        return os.path.join(self.index_dir, "index.faiss")
+
+    @property
+    def index(self):
+        """
+        The FAISS index. In mmap mode it is opened on first access.
+        """
+        if self._index is None:
+            with self._index_lock:
+                if self._index is None:
+                    self._index = self._read_index()
+        return self._index
+
+    @property
+    def lexical(self):
+        """
+        BM25 index over the texts, built on first hybrid / bm25 retrieval.
+        """
+        if self._lexical is None:
+            with self._index_lock:
+                if self._lexical is None:
+                    self._lexical = BM25Index.build(self.texts)
+                    print(f"[Loader] BM25 index with {len(self._lexical.vocab)} terms")
+        return self._lexical
+
+    def _read_index(self):
+        index = None
+        if self.mmap:
+            try:
+                index = faiss.read_index(self.index_path, mmap_io_flags())
+                print(f"[Loader] Memory-mapped index with {index.ntotal} vectors")
+            except RuntimeError:
+                # e.g. IVF array inverted lists cannot be mapped; read normally
+                print("[Loader] Index type does not support mmap, reading into memory")
+        if index is None:
+            index = faiss.read_index(self.index_path)
+        return apply_search_params(index, INDEX_PARAMS.get(self.index_type, {}))
+
+    def load(self, embedder=None):
+        """
+        Loads the active generation. Pass the `embedder` of a loader for the
+        same model to reuse it (hot reload) instead of loading it again.
+        """
+        self.index_dir = resolve_index_dir(self.index_root)
+        metadata_path = os.path.join(self.index_dir, "metadatas.pkl")
 
-    def load(self):
-        index_path = os.path.join(INDEX_DIR, "index.faiss")
-        metadata_path = os.path.join(INDEX_DIR, "metadatas.pkl")
+        if not os.path.exists(self.index_path):
+            raise FileNotFoundError("FAISS index not found at " + self.index_path)
 
-        if not os.path.exists(index_path):
-            raise FileNotFoundError("FAISS index not found at " + index_path)
+        if has_text_store(self.index_dir):
+            # columnar store: rows are decoded only when retrieved
+            self.texts = TextStore(self.index_dir)
+            self.meta = MetadataTable(self.index_dir)
+        else:
+            with open(metadata_path, "rb") as f:
+                meta = pickle.load(f)
 
-        self.index = faiss.read_index(index_path)
+            self.texts = meta["texts"]
+            self.meta = meta["metadatas"]
 
-        with open(metadata_path, "rb") as f:
-            meta = pickle.load(f)
+        # query-independent per-row fields, computed once per index
+        self.derived = load_derived(self.index_dir, self.texts)
 
-        self.texts = meta["texts"]
-        self.meta = meta["metadatas"]
+        if embedder is not None:
+            self.embedder = embedder
+        else:
+            from encoder import load_encoder  # heavy import, deferred to first load
 
-        self.embedder = SentenceTransformer(EMBEDDING_MODEL, device=DEVICE)
+            self.embedder = load_encoder(self.embedding_model, self.encoder_backend)
 
-        print(f"[Loader] Loaded index with {self.index.ntotal} vectors")
+        if self.mmap:
+            # deferred until the first retrieve()
+            print(f"[Loader] Index at {self.index_path} will be mapped on first search")
+        else:
+            print(f"[Loader] Loaded index with {self.index.ntotal} vectors")
         return self
 
-loader = PairIndexLoader().load()
+# built on first use (or by startup.warm_up), not at import
+loader = Lazy("index", lambda: PairIndexLoader().load())
@@ -0,0 +1,145 @@
+"""
+Lazily loaded, LRU-evicted set of resident LLMs.
+
+Models are loaded by name on first use. At most `max_resident` stay loaded,
+and their combined footprint is kept under `memory_budget_gb`; the least
+recently used model is evicted first. Loads in flight hold their slot, so
+concurrent first uses of different models never exceed the limits, and a
+load that fails reloads the models it evicted. Callers already holding an
+evicted model keep a working reference until they are done with it.
+"""
+import gc
+import threading
+from collections import OrderedDict
+
+
+class ModelRegistry:
+    def __init__(self, specs, load_fn, max_resident: int = 1, memory_budget_gb: float = None):
+        """
+        specs: name -> dict with at least "model_id" and optionally "approx_gb"
+        load_fn(name, spec) -> handle; handle.footprint_gb and handle.close() are optional.
+        close() is called on eviction and must leave the handle usable by
+        callers that still hold it; memory is freed when the last one drops it.
+        """
+        self.specs = specs
+        self.load_fn = load_fn
+        self.max_resident = max_resident
+        self.memory_budget_gb = memory_budget_gb
+        self._resident = OrderedDict()  # name -> handle, LRU first
+        # guards the state below; notified whenever a load finishes
+        self._lock = threading.Condition()
+        self._loading = {}  # name -> expected GB of loads in flight; they hold a slot
+        self.loads = 0
+        self.evictions = 0
+
+    def names(self):
+        return list(self.specs)
+
+    def resident(self):
+        with self._lock:
+            return list(self._resident)
+
+    def _footprint(self, name, handle=None):
+        gb = getattr(handle, "footprint_gb", None)
+        if gb is None:
+            gb = self.specs[name].get("approx_gb", 0.0)
+        return gb
+
+    def _used_gb(self):
+        return sum(self._footprint(n, h) for n, h in self._resident.items()) + sum(self._loading.values())
+
+    def _over_limits(self, needed):
+        return len(self._resident) + len(self._loading) >= self.max_resident or (
+            self.memory_budget_gb is not None and self._used_gb() + needed > self.memory_budget_gb
+        )
+
+    def _reserve(self, name):
+        """
+        Under the lock: evicts LRU models until `name` fits next to the
+        resident models and the loads already in flight, then reserves its
+        slot. Returns the evicted (name, handle) pairs, or None when only
+        in-flight loads are in the way (the caller waits for them).
+        """
+        needed = self._footprint(name)
+        evicted = []
+        while self._resident and self._over_limits(needed):
+            evicted.append(self._resident.popitem(last=False))
+        if self._loading and self._over_limits(needed):
+            # put them back, oldest first, and wait for a running load to finish
+            for old_name, handle in reversed(evicted):
+                self._resident[old_name] = handle
+                self._resident.move_to_end(old_name, last=False)
+            return None
+        self._loading[name] = needed
+        return evicted
+
+    def _release(self, evicted):
+        for old_name, handle in evicted:
+            close = getattr(handle, "close", None)
+            if close is not None:
+                close()
+            self.evictions += 1
+            print(f"[Registry] Evicted {old_name}")
+        if evicted:
+            # drop our references before collecting
+            evicted.clear()
+            handle = None
+            gc.collect()
+            try:
+                import torch
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+            except ImportError:
+                pass
+
+    def get(self, name):
+        if name not in self.specs:
+            raise KeyError(f"Unknown model '{name}'. Available: {', '.join(self.specs)}")
+
+        with self._lock:
+            while True:
+                if name in self._resident:
+                    self._resident.move_to_end(name)
+                    return self._resident[name]
+                if name not in self._loading:
+                    evicted = self._reserve(name)
+                    if evicted is not None:
+                        break
+                # another thread is loading this model, or holds the slot we need
+                self._lock.wait()
+
+        evicted_names = [old_name for old_name, _ in evicted]
+        try:
+            self._release(evicted)
+            handle = self.load_fn(name, self.specs[name])
+        except Exception:
+            with self._lock:
+                self._loading.pop(name, None)
+                self._lock.notify_all()
+            self._restore(evicted_names)
+            raise
+
+        with self._lock:
+            self._loading.pop(name, None)
+            self._resident[name] = handle
+            self.loads += 1
+            self._lock.notify_all()
+        print(f"[Registry] Loaded {name}")
+        return handle
+
+    def _restore(self, names):
+        """After a failed load, reloads the models it evicted so they keep serving."""
+        for old_name in names:
+            try:
+                self.get(old_name)
+            except Exception as e:
+                print(f"[Registry] Could not restore {old_name}: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "resident": list(self._resident),
+                "used_gb": self._used_gb(),
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
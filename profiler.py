@@ -0,0 +1,147 @@
+"""
+Lightweight per-request stage timing.
+
+    with profiler.request() as timings:
+        with profiler.span("embed"):
+            ...
+    timings  # {"embed": 12.3, ...} in milliseconds
+
+Spans accumulate into the dict of the active request (a ContextVar, so
+concurrent requests in threads or asyncio tasks do not mix). When profiling
+is disabled, or no request is active, span() returns a shared no-op context.
+Stage durations can also be exported as a Prometheus histogram, and
+pipeline decisions (e.g. skipped LLM calls) are counted with count().
+Current levels (e.g. the LLM scheduler queue depth) are set with gauge().
+"""
+import contextvars
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from config import PROFILING, PROMETHEUS_METRICS, PROMETHEUS_PORT
+
+try:
+    import prometheus_client
+except ImportError:  # optional dependency
+    prometheus_client = None
+
+_NOOP = nullcontext()
+_current = contextvars.ContextVar("profiler_timings", default=None)
+
+
+class _Span:
+    __slots__ = ("profiler", "name", "t0")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, (time.perf_counter() - self.t0) * 1000)
+        return False
+
+
+class Profiler:
+    def __init__(self, enabled: bool = PROFILING, prometheus: bool = PROMETHEUS_METRICS):
+        self.enabled = enabled
+        self._histogram = None
+        self._counter = None
+        self._gauge = None
+        self._counts = {}
+        self._gauges = {}
+        self._counts_lock = threading.Lock()
+        if prometheus and prometheus_client is not None:
+            self._histogram = prometheus_client.Histogram(
+                "rag_stage_seconds",
+                "Time spent per pipeline stage",
+                ["stage"],
+            )
+            self._counter = prometheus_client.Counter(
+                "rag_events",
+                "Pipeline decisions and events",
+                ["event"],
+            )
+            self._gauge = prometheus_client.Gauge(
+                "rag_gauge",
+                "Current pipeline levels (queue depth, batch size)",
+                ["gauge"],
+            )
+
+    def start_metrics_server(self, port: int = PROMETHEUS_PORT):
+        """Serves /metrics over HTTP, if Prometheus export is on."""
+        if self._histogram is not None and port:
+            prometheus_client.start_http_server(port)
+
+    @contextmanager
+    def request(self):
+        """Collects the spans of one request into a fresh dict."""
+        timings = {}
+        if not self.enabled:
+            yield timings
+            return
+        token = _current.set(timings)
+        try:
+            yield timings
+        finally:
+            _current.reset(token)
+
+    def current(self):
+        return _current.get()
+
+    def span(self, name: str):
+        if not self.enabled or _current.get() is None:
+            return _NOOP
+        return _Span(self, name)
+
+    def record(self, name: str, ms: float):
+        """Adds `ms` to stage `name` of the active request."""
+        timings = _current.get()
+        if not self.enabled or timings is None:
+            return
+        timings[name] = timings.get(name, 0.0) + ms
+        if self._histogram is not None:
+            self._histogram.labels(stage=name).observe(ms / 1000)
+
+    def count(self, name: str, n: int = 1):
+        """Increments event counter `name` (process-wide, not per request)."""
+        with self._counts_lock:
+            self._counts[name] = self._counts.get(name, 0) + n
+        if self._counter is not None:
+            self._counter.labels(event=name).inc(n)
+
+    def counts(self):
+        with self._counts_lock:
+            return dict(self._counts)
+
+    def gauge(self, name: str, value: float):
+        """Sets the current value of gauge `name` (process-wide)."""
+        with self._counts_lock:
+            self._gauges[name] = value
+        if self._gauge is not None:
+            self._gauge.labels(gauge=name).set(value)
+
+    def gauges(self):
+        with self._counts_lock:
+            return dict(self._gauges)
+
+    def iter_with(self, iterable, timings):
+        """
+        Iterates a lazy stream with `timings` active, so spans recorded while
+        the stream is consumed land in the request that created it.
+        """
+        it = iter(iterable)
+        while True:
+            token = _current.set(timings)
+            try:
+                chunk = next(it)
+            except StopIteration:
+                return
+            finally:
+                _current.reset(token)
+            yield chunk
+
+
+profiler = Profiler()
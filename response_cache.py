@@ -0,0 +1,157 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+def bucket_key(doc_key, **params) -> str:
+    """
+    Entries are only compared with others for the same top document
+    (its content hash) and the same generation parameters.
+    """
+    return json.dumps({"doc": doc_key, **params}, sort_keys=True)
+
+
+class SemanticResponseCache:
+    """
+    Bounded LRU cache of final LLM answers, looked up by cosine similarity
+    of the query embedding within a (top document, generation params) bucket.
+    Optional TTL and an optional SQLite tier that survives restarts.
+    """
+
+    def __init__(self, threshold: float = 0.95, max_size: int = 1024, ttl: float = None, disk_path: str = None):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # entry id -> (bucket, created_at, vector, answer)
+        self._buckets = {}             # bucket -> set of entry ids
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._db = None
+
+        if disk_path:
+            os.makedirs(os.path.dirname(disk_path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "id INTEGER PRIMARY KEY, bucket TEXT, created_at REAL, vector BLOB, answer TEXT)"
+            )
+            self._db.commit()
+            self._load()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+    def _expired(self, created_at):
+        return self.ttl is not None and time.time() - created_at > self.ttl
+
+    def _load(self):
+        """Restores the newest max_size unexpired entries from disk."""
+        if self.ttl is not None:
+            self._db.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl,))
+        rows = self._db.execute(
+            "SELECT id, bucket, created_at, vector, answer FROM responses ORDER BY created_at DESC"
+        ).fetchall()
+        self._db.executemany(
+            "DELETE FROM responses WHERE id = ?", [(row[0],) for row in rows[self.max_size:]]
+        )
+        self._db.commit()
+        for entry_id, bucket, created_at, vector, answer in reversed(rows[:self.max_size]):
+            self._put_memory(entry_id, bucket, created_at, np.frombuffer(vector, dtype="float32"), answer)
+        self._next_id = max((row[0] for row in rows), default=-1) + 1
+
+    def _remove(self, entry_id):
+        bucket = self._entries.pop(entry_id)[0]
+        ids = self._buckets[bucket]
+        ids.discard(entry_id)
+        if not ids:
+            del self._buckets[bucket]
+        if self._db is not None:
+            self._db.execute("DELETE FROM responses WHERE id = ?", (entry_id,))
+
+    def _put_memory(self, entry_id, bucket, created_at, vector, answer):
+        self._entries[entry_id] = (bucket, created_at, vector, answer)
+        self._buckets.setdefault(bucket, set()).add(entry_id)
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+
+    def get(self, bucket: str, query_embedding):
+        """
+        Stored answer of the most similar cached query in the bucket,
+        if its cosine is at least `threshold`; otherwise None.
+        """
+        query_embedding = np.asarray(query_embedding, dtype="float32").reshape(-1)
+        with self._lock:
+            best_id, best_score = None, self.threshold
+            for entry_id in list(self._buckets.get(bucket, ())):
+                _, created_at, vector, _ = self._entries[entry_id]
+                if self._expired(created_at):
+                    self._remove(entry_id)
+                    continue
+                score = float(vector @ query_embedding)
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+
+            if best_id is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(best_id)
+            return self._entries[best_id][3]
+
+    def put(self, bucket: str, query_embedding, answer: str):
+        vector = np.asarray(query_embedding, dtype="float32").reshape(-1).copy()
+        now = time.time()
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._put_memory(entry_id, bucket, now, vector, answer)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                    (entry_id, bucket, now, vector.tobytes(), answer),
+                )
+                self._db.commit()
+
+    def caching_stream(self, bucket: str, query_embedding, chunks):
+        """
+        Passes a streamed answer through and stores it once fully consumed.
+        """
+        parts = []
+        for chunk in chunks:
+            parts.append(chunk)
+            yield chunk
+        answer = "".join(parts).strip()
+        if answer:
+            self.put(bucket, query_embedding, answer)
+
+    async def acaching_stream(self, bucket: str, query_embedding, chunks):
+        """Same as caching_stream for an async stream."""
+        parts = []
+        async for chunk in chunks:
+            parts.append(chunk)
+            yield chunk
+        answer = "".join(parts).strip()
+        if answer:
+            # SQLite write off the event loop
+            await asyncio.to_thread(self.put, bucket, query_embedding, answer)
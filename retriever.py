@@ -1,28 +1,211 @@
+import threading
+import time
 import faiss
-from loader import loader
-from config import TOP_K
+from loader import loader, current_generation, PairIndexLoader
+from startup import Lazy
+from embedding_cache import QueryEmbeddingCache
+from profiler import profiler
+from lexical_index import rrf_fuse, weighted_fuse
+from config import (
+    TOP_K, ENCODE_BATCH_SIZE,
+    QUERY_CACHE_SIZE, QUERY_CACHE_TTL, QUERY_CACHE_PATH,
+    INDEX_RELOAD_INTERVAL,
+    RETRIEVAL_MODE, HYBRID_FUSION, HYBRID_DEPTH, HYBRID_DENSE_WEIGHT,
+)
+
+MODES = ("dense", "bm25", "hybrid")
 
 class PairRetriever:
-    def __init__(self, index_loader=loader):
-        self.index = index_loader.index
-        self.texts = index_loader.texts
-        self.meta = index_loader.meta
-        self.embedder = index_loader.embedder
-
-    def retrieve(self, query, k=TOP_K):
-        q_emb = self.embedder.encode([query], convert_to_numpy=True).astype("float32")
-        faiss.normalize_L2(q_emb)
-        D, I = self.index.search(q_emb, k)
-
-        results = []
-        for score, idx in zip(D[0], I[0]):
-            if idx < 0:
-                continue
-            results.append({
-                "score": float(score),
-                "pair_text": self.texts[idx],
-                "metadata": self.meta[idx]
-            })
-        return results
-
-retriever = PairRetriever()
+    def __init__(self, index_loader=loader, reload_interval=INDEX_RELOAD_INTERVAL):
+        if isinstance(index_loader, Lazy):
+            index_loader = index_loader.get()
+        # the loaded generation; replaced as a whole by a hot reload
+        self.loader = index_loader
+        self.reload_interval = reload_interval
+        self._generation = current_generation(index_loader.index_root)
+        self._checked_at = time.monotonic()
+        self._reload_lock = threading.Lock()
+        self._reloading = False
+        self.query_cache = None
+        if QUERY_CACHE_SIZE > 0:
+            # vectors from different backends are close but not identical
+            self.query_cache = QueryEmbeddingCache(
+                f"{index_loader.embedding_model}@{index_loader.encoder_backend}",
+                max_size=QUERY_CACHE_SIZE,
+                ttl=QUERY_CACHE_TTL,
+                disk_path=QUERY_CACHE_PATH,
+            )
+
+    @property
+    def index(self):
+        # resolved per call so a memory-mapped index opens on first search
+        return self.loader.index
+
+    @property
+    def texts(self):
+        return self.loader.texts
+
+    @property
+    def meta(self):
+        return self.loader.meta
+
+    @property
+    def derived(self):
+        return self.loader.derived
+
+    @property
+    def embedder(self):
+        return self.loader.embedder
+
+    # -------------------------
+    # Hot reload
+    # -------------------------
+    def reload_if_changed(self):
+        """
+        Cheap, throttled check of the index CURRENT pointer. A new generation
+        is loaded on a background thread and swapped in when ready; requests
+        keep using the generation they started with.
+        """
+        if self.reload_interval is None:
+            return
+        now = time.monotonic()
+        if now - self._checked_at < self.reload_interval:
+            return
+        self._checked_at = now
+
+        generation = current_generation(self.loader.index_root)
+        if generation == self._generation:
+            return
+        with self._reload_lock:
+            if self._reloading:
+                return
+            self._reloading = True
+        threading.Thread(target=self._reload, args=(generation,), name="index-reload", daemon=True).start()
+
+    def _reload(self, generation):
+        old = self.loader
+        try:
+            new = PairIndexLoader(
+                index_dir=old.index_root,
+                mmap=old.mmap,
+                index_type=old.index_type,
+                embedding_model=old.embedding_model,
+                encoder_backend=old.encoder_backend,
+            ).load(embedder=old.embedder)
+            new.index  # open / map it before any request sees it
+            if RETRIEVAL_MODE != "dense":
+                new.lexical
+            self.loader = new
+            self._generation = generation
+            print(f"[Retriever] Switched to index generation {generation} ({new.index.ntotal} vectors)")
+        except Exception as e:
+            # keep serving the current generation; retried at the next check
+            print(f"[Retriever] Reload of generation {generation} failed: {e}")
+        finally:
+            self._reloading = False
+
+    def embed_queries(self, queries, batch_size=ENCODE_BATCH_SIZE):
+        """
+        L2-normalized float32 query embeddings, served from the cache when possible.
+        """
+        def encode(texts):
+            return self.embedder.encode(
+                list(texts), batch_size=batch_size, convert_to_numpy=True
+            )
+
+        with profiler.span("embed"):
+            if self.query_cache is not None:
+                q_emb = self.query_cache.encode(list(queries), encode)
+            else:
+                q_emb = encode(queries).astype("float32")
+            faiss.normalize_L2(q_emb)
+        return q_emb
+
+    def retrieve(self, query, k=TOP_K, mode=None):
+        return self.retrieve_many([query], k, mode=mode)[0]
+
+    def retrieve_many(self, queries, k=TOP_K, batch_size=ENCODE_BATCH_SIZE, return_embeddings=False, mode=None):
+        """
+        Retrieves top-k pairs for every query with one encode call
+        and one FAISS search over the whole query matrix.
+        `mode` is "dense", "bm25" or "hybrid" (both, fused); None uses RETRIEVAL_MODE.
+        With return_embeddings=True, returns (results, normalized query embeddings).
+        """
+        mode = mode or RETRIEVAL_MODE
+        if mode not in MODES:
+            raise ValueError(f"Unknown retrieval mode {mode!r}, expected one of {MODES}")
+        if not queries:
+            return ([], None) if return_embeddings else []
+
+        self.reload_if_changed()
+        # one generation for the whole call, even if a reload swaps it meanwhile
+        generation = self.loader
+
+        q_emb = None
+        if mode != "bm25" or return_embeddings:
+            q_emb = self.embed_queries(queries, batch_size)
+
+        all_results = []
+        for ranked, hits in self.rank(queries, q_emb, k, mode, generation):
+            results = []
+            for idx, score in ranked:
+                results.append({
+                    "id": idx,
+                    "score": score,
+                    # cosine similarity, None when dense search did not return the pair
+                    "dense_score": hits.get(idx) if hits is not None else None,
+                    "pair_text": generation.texts[idx],
+                    "metadata": generation.meta[idx],
+                    # row lookups (derived fields) must use the same generation
+                    "generation": generation,
+                })
+            all_results.append(results)
+        if return_embeddings:
+            return all_results, q_emb
+        return all_results
+
+    def rank(self, queries, q_emb, k, mode, generation=None):
+        """
+        Per query, ([(row id, score)] best first, dense {row id: cosine} or None).
+        q_emb may be None in "bm25" mode.
+        """
+        generation = generation or self.loader
+        # hybrid fuses deeper lists than it returns
+        depth = k if mode != "hybrid" else max(k, HYBRID_DEPTH)
+        dense = [None] * len(queries)
+        if mode != "bm25":
+            with profiler.span("search"):
+                D, I = generation.index.search(q_emb, depth)
+            dense = [
+                {int(idx): float(score) for score, idx in zip(scores, ids) if idx >= 0}
+                for scores, ids in zip(D, I)
+            ]
+
+        lexical = [None] * len(queries)
+        if mode != "dense":
+            with profiler.span("bm25"):
+                lexical = [generation.lexical.search(query, depth) for query in queries]
+
+        ranked = []
+        for hits, lex in zip(dense, lexical):
+            if mode == "dense":
+                ranked.append((list(hits.items()), hits))
+            elif mode == "bm25":
+                ranked.append(([(int(i), float(s)) for s, i in zip(*lex)], None))
+            else:
+                ranked.append((self._fuse(hits, lex, k), hits))
+        return ranked
+
+    @staticmethod
+    def _fuse(dense, lexical, k):
+        """[(id, fused score)] of the top k of dense {id: score} and BM25 (scores, ids)."""
+        lex_scores, lex_ids = lexical
+        if HYBRID_FUSION == "weighted":
+            scores, ids = weighted_fuse(
+                dense, {int(i): float(s) for s, i in zip(lex_scores, lex_ids)}, k, HYBRID_DENSE_WEIGHT
+            )
+        else:
+            scores, ids = rrf_fuse([list(dense), [int(i) for i in lex_ids]], k)
+        return list(zip(ids, scores))
+
+retriever = Lazy("retriever", PairRetriever)
@@ -0,0 +1,276 @@
+"""
+Multi-pattern keyword safety scanner.
+
+All keyword lists are compiled into one Aho-Corasick automaton, so a text
+is scanned once regardless of how many keywords or categories there are,
+and every match is reported with its category and span. Lists can be
+reloaded from a JSON file ({"category": ["keyword", ...]}) at runtime.
+"""
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+import numpy as np
+from config import (
+    SELFHARM_KEYWORDS, ABUSE_KEYWORDS, SAFETY_CATEGORIES,
+    SAFETY_KEYWORDS_PATH, SAFETY_RELOAD_INTERVAL,
+    SAFETY_PROTOTYPES, SAFETY_EMBEDDING_THRESHOLDS,
+)
+
+_LEVEL_ORDER = {"ok": 0, "low": 1, "medium": 2, "high": 3}
+
+
+class KeywordAutomaton:
+    """
+    Aho-Corasick automaton over lowercased keywords.
+    """
+
+    def __init__(self, keywords_by_category):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        self.size = 0
+
+        for category, keywords in keywords_by_category.items():
+            for keyword in keywords:
+                keyword = keyword.lower()
+                if not keyword:
+                    continue
+                node = 0
+                for ch in keyword:
+                    nxt = self.goto[node].get(ch)
+                    if nxt is None:
+                        nxt = len(self.goto)
+                        self.goto[node][ch] = nxt
+                        self.goto.append({})
+                        self.fail.append(0)
+                        self.out.append([])
+                    node = nxt
+                self.out[node].append((category, keyword))
+                self.size += 1
+
+        # breadth-first failure links; outputs inherit those of their fail node
+        q = deque(self.goto[0].values())
+        while q:
+            node = q.popleft()
+            for ch, nxt in self.goto[node].items():
+                q.append(nxt)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def find_all(self, text):
+        """
+        Yields (category, keyword, start, end) for every keyword occurrence.
+        Spans index into text.lower().
+        """
+        goto, fail, out = self.goto, self.fail, self.out
+        node = 0
+        for i, ch in enumerate(text.lower()):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for category, keyword in out[node]:
+                yield category, keyword, i - len(keyword) + 1, i + 1
+
+
+def most_severe(categories, category_info=SAFETY_CATEGORIES):
+    """(level, reason) of the most severe category in `categories`."""
+    level, reason = "ok", ""
+    for category in categories:
+        info = category_info.get(category, {"level": "medium", "reason": category})
+        if _LEVEL_ORDER.get(info["level"], 0) > _LEVEL_ORDER[level]:
+            level, reason = info["level"], info["reason"]
+    return level, reason
+
+
+def default_keywords():
+    return {"self_harm": list(SELFHARM_KEYWORDS), "abuse": list(ABUSE_KEYWORDS)}
+
+
+class SafetyScanner:
+    def __init__(self, keywords_path=SAFETY_KEYWORDS_PATH, categories=SAFETY_CATEGORIES,
+                 reload_interval=SAFETY_RELOAD_INTERVAL):
+        self.keywords_path = keywords_path
+        self.categories = categories
+        self.reload_interval = reload_interval
+        self._mtime = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.automaton = None
+        self.fingerprint = None
+        self.reload()
+
+    def reload(self, keywords_path=None):
+        """
+        Rebuilds the automaton from the keywords file (or the config lists)
+        and swaps it in; scans already running keep the old one.
+        """
+        path = keywords_path or self.keywords_path
+        keywords = default_keywords()
+        mtime = None
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                keywords = json.load(f)
+            mtime = os.path.getmtime(path)
+
+        automaton = KeywordAutomaton(keywords)
+        # identifies the keyword set that precomputed scan results were made with
+        fingerprint = hashlib.sha1(
+            json.dumps([keywords, self.categories], sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        with self._lock:
+            self.keywords_path = path
+            self.automaton = automaton
+            self.fingerprint = fingerprint
+            self._mtime = mtime
+        print(f"[Safety] Compiled {automaton.size} keywords in {len(keywords)} categories")
+        return self
+
+    def reload_if_changed(self):
+        """Cheap, throttled check for an edited keywords file."""
+        if not self.keywords_path:
+            return
+        now = time.monotonic()
+        if now - self._checked_at < self.reload_interval:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.path.getmtime(self.keywords_path)
+        except OSError:
+            return
+        if mtime != self._mtime:
+            self.reload()
+
+    def scan(self, text: str):
+        """
+        One pass over the text. Returns the most severe level, its reason,
+        every matched category and every match span.
+        """
+        self.reload_if_changed()
+
+        matches = [
+            {"category": c, "keyword": k, "start": s, "end": e}
+            for c, k, s, e in self.automaton.find_all(text)
+        ]
+        categories = sorted({m["category"] for m in matches})
+        level, reason = most_severe(categories, self.categories)
+        return {"level": level, "reason": reason, "categories": categories, "matches": matches}
+
+
+class EmbeddingSafetyClassifier:
+    """
+    Scores an already computed, L2-normalized query embedding against
+    prototype sentences per category: one small matrix-vector product,
+    no extra model. Prototypes are embedded once, on first use.
+    """
+
+    def __init__(self, encode_fn, prototypes=SAFETY_PROTOTYPES,
+                 thresholds=SAFETY_EMBEDDING_THRESHOLDS, categories=SAFETY_CATEGORIES):
+        """
+        encode_fn(texts) -> L2-normalized float32 matrix, same encoder as the retriever
+        """
+        self.encode_fn = encode_fn
+        self.prototypes = prototypes
+        self.thresholds = thresholds
+        self.categories = categories
+        self._matrix = None
+        self._row_category = None
+        self._lock = threading.Lock()
+
+    def _ensure_prototypes(self):
+        if self._matrix is None:
+            with self._lock:
+                if self._matrix is None:
+                    names, texts = [], []
+                    for category, sentences in self.prototypes.items():
+                        names.extend([category] * len(sentences))
+                        texts.extend(sentences)
+                    self._row_category = np.array(names)
+                    self._matrix = np.asarray(self.encode_fn(texts), dtype="float32")
+
+    def scores(self, query_embedding):
+        """category -> cosine to its closest prototype."""
+        self._ensure_prototypes()
+        sims = self._matrix @ np.asarray(query_embedding, dtype="float32").reshape(-1)
+        return {
+            category: float(sims[self._row_category == category].max())
+            for category in self.prototypes
+        }
+
+    def classify(self, query_embedding):
+        scores = self.scores(query_embedding)
+        categories = sorted(
+            c for c, score in scores.items() if score >= self.thresholds.get(c, 1.0)
+        )
+        level, reason = most_severe(categories, self.categories)
+        return {"level": level, "reason": reason, "categories": categories, "scores": scores}
+
+
+def merge_safety(*results):
+    """
+    Combines safety results: the most severe level wins, categories and
+    keyword matches are unioned, embedding scores are kept.
+    """
+    merged = {"level": "ok", "reason": "", "categories": [], "matches": []}
+    for r in results:
+        if not r:
+            continue
+        if _LEVEL_ORDER.get(r["level"], 0) > _LEVEL_ORDER[merged["level"]]:
+            merged["level"], merged["reason"] = r["level"], r["reason"]
+        merged["categories"] = sorted(set(merged["categories"]) | set(r.get("categories", [])))
+        merged["matches"].extend(r.get("matches", []))
+        if "scores" in r:
+            merged["embedding_scores"] = r["scores"]
+    return merged
+
+
+scanner = SafetyScanner()
+
+
+def calibrate_embedding_thresholds(dataset_path: str = "cleaned_dataset.json", target_rate: float = 0.01):
+    """
+    Scores every dataset instruction with the embedding classifier. For each
+    category, reports how many instructions the current threshold flags, how
+    many of those the keyword scanner does not flag (likely false positives),
+    and the threshold that flags `target_rate` of the keyword-clean instructions.
+    """
+    from retriever import retriever
+
+    with open(dataset_path, "r", encoding="utf-8") as f:
+        instructions = [row["instruction"] for row in json.load(f)]
+    classifier = EmbeddingSafetyClassifier(retriever.embed_queries)
+    embeddings = retriever.embed_queries(instructions)
+    scores = [classifier.scores(e) for e in embeddings]
+    keyword_hits = [set(scanner.scan(q)["categories"]) for q in instructions]
+
+    report = {}
+    for category in classifier.prototypes:
+        cat_scores = np.array([s[category] for s in scores])
+        clean = np.array([category not in hits for hits in keyword_hits])
+        threshold = classifier.thresholds.get(category, 1.0)
+        flagged = cat_scores >= threshold
+        report[category] = {
+            "threshold": threshold,
+            "flagged_rate": float(flagged.mean()),
+            "false_positive_rate": float(flagged[clean].mean()) if clean.any() else 0.0,
+            "suggested_threshold": float(np.quantile(cat_scores[clean], 1 - target_rate)) if clean.any() else threshold,
+        }
+        r = report[category]
+        print(f"[Safety] {category}: threshold {threshold:.2f} flags {r['flagged_rate']:.1%} of "
+              f"{len(instructions)} instructions, {r['false_positive_rate']:.1%} without a keyword match; "
+              f"{r['suggested_threshold']:.3f} would flag {target_rate:.1%}")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate the embedding safety thresholds on the dataset instructions")
+    parser.add_argument("--dataset", default="cleaned_dataset.json")
+    parser.add_argument("--target_rate", type=float, default=0.01)
+    args = parser.parse_args()
+    calibrate_embedding_thresholds(args.dataset, args.target_rate)
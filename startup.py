@@ -0,0 +1,98 @@
+"""
+Lazy, thread-safe singletons and startup timing.
+
+Heavy objects (index + encoder, LLM client, Whisper) are built on first use
+instead of at import time, or ahead of time on a background thread with
+warm_up(). A Lazy proxies attribute access to the object it builds, so
+`retriever.retrieve_many(...)` works unchanged:
+
+    retriever = Lazy("retriever", PairRetriever)
+
+Module imports (timed_import) and builds are timed for startup_report().
+"""
+import importlib
+import sys
+import threading
+import time
+
+_timings = {"imports": {}, "loads": {}}
+_timings_lock = threading.Lock()
+
+
+def _record(kind: str, name: str, seconds: float):
+    with _timings_lock:
+        _timings[kind][name] = seconds * 1000
+
+
+def timed_import(module_name: str):
+    """importlib.import_module, recording how long a first import took."""
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    t0 = time.perf_counter()
+    module = importlib.import_module(module_name)
+    _record("imports", module_name, time.perf_counter() - t0)
+    return module
+
+
+class Lazy:
+    """
+    Builds `factory()` once, on first use, under a lock.
+    """
+
+    def __init__(self, name: str, factory):
+        self._name = name
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._value = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._value is not None
+
+    def get(self):
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    t0 = time.perf_counter()
+                    value = self._factory()
+                    _record("loads", self._name, time.perf_counter() - t0)
+                    self._value = value
+        return self._value
+
+    def __getattr__(self, attr):
+        # only reached for attributes the proxy itself does not have
+        return getattr(self.get(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self.loaded else "not loaded"
+        return f"<Lazy {self._name} ({state})>"
+
+
+def warm_up(*tasks):
+    """
+    Runs the given Lazy objects (or (name, fn) pairs) in order on a daemon
+    thread, so the first request does not pay for them. Returns the thread.
+    """
+    def _run():
+        for task in tasks:
+            name = task._name if isinstance(task, Lazy) else task[0]
+            try:
+                if isinstance(task, Lazy):
+                    task.get()
+                else:
+                    t0 = time.perf_counter()
+                    task[1]()
+                    _record("loads", name, time.perf_counter() - t0)
+            except Exception as e:
+                # the request that needs it will retry and surface the error
+                print(f"[Startup] Warm-up of {name} failed: {e}")
+
+    thread = threading.Thread(target=_run, name="warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+def startup_report():
+    """Milliseconds per timed module import and per singleton build so far."""
+    with _timings_lock:
+        return {kind: dict(values) for kind, values in _timings.items()}
@@ -0,0 +1,192 @@
+"""
+Columnar, memory-mapped store for the pair texts and their metadata.
+
+Layout inside an index directory:
+- texts.bin          all texts as one contiguous UTF-8 blob
+- texts.offsets.npy  int64 byte offsets, len(texts) + 1 entries
+- metadatas.json     field names + distinct values per field
+- metadatas.codes.npy  int32 (n_rows, n_fields) codes into those values
+
+Other text columns (e.g. derived fields) use the same blob + offsets layout
+under their own name.
+
+Rows are decoded on access, so a search only pays for the k rows it returns.
+"""
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import threading
+from contextlib import contextmanager
+import numpy as np
+from config import INDEX_DIR
+
+TEXTS_NAME = "texts"
+META_FILE = "metadatas.json"
+CODES_FILE = "metadatas.codes.npy"
+
+_MISSING = -1
+
+
+def content_hash(text: str) -> str:
+    """Identity of a stored text that, unlike its row, survives rebuilds."""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _blob_path(index_dir, name):
+    return os.path.join(index_dir, f"{name}.bin")
+
+
+def _offsets_path(index_dir, name):
+    return os.path.join(index_dir, f"{name}.offsets.npy")
+
+
+def has_text_store(index_dir, name=TEXTS_NAME):
+    return os.path.exists(_offsets_path(index_dir, name))
+
+
+class TextStore:
+    """
+    Read-only sequence of strings backed by a memory-mapped blob.
+    """
+
+    def __init__(self, index_dir, name=TEXTS_NAME):
+        self.offsets = np.load(_offsets_path(index_dir, name), mmap_mode="r")
+        blob_path = _blob_path(index_dir, name)
+        if os.path.getsize(blob_path) > 0:
+            self.blob = np.memmap(blob_path, dtype=np.uint8, mode="r")
+        else:
+            self.blob = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("text index out of range")
+        start, end = int(self.offsets[idx]), int(self.offsets[idx + 1])
+        return self.blob[start:end].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class MetadataTable:
+    """
+    Read-only sequence of metadata dicts stored as dictionary-encoded columns.
+    """
+
+    def __init__(self, index_dir):
+        with open(os.path.join(index_dir, META_FILE), "r", encoding="utf-8") as f:
+            table = json.load(f)
+        self.fields = table["fields"]
+        self.values = table["values"]
+        self.codes = np.load(os.path.join(index_dir, CODES_FILE), mmap_mode="r")
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        row = self.codes[idx]
+        return {
+            field: self.values[field][code]
+            for field, code in zip(self.fields, row.tolist())
+            if code != _MISSING
+        }
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+@contextmanager
+def atomic_write(path, mode="wb", **kwargs):
+    """
+    Opens a private temporary file that replaces `path` on success. Processes
+    that have the old file memory-mapped keep reading the old contents.
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, mode, **kwargs) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_texts(index_dir, texts, name=TEXTS_NAME):
+    """
+    Writes one text column as a UTF-8 blob + offsets.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+
+    encoded = [t.encode("utf-8") for t in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    if encoded:
+        offsets[1:] = np.cumsum([len(b) for b in encoded])
+    with atomic_write(_blob_path(index_dir, name)) as f:
+        for b in encoded:
+            f.write(b)
+    with atomic_write(_offsets_path(index_dir, name)) as f:
+        np.save(f, offsets)
+
+
+def write_text_store(index_dir, texts, metadatas):
+    """
+    Writes texts + metadatas in the columnar layout.
+    """
+    write_texts(index_dir, texts)
+
+    fields = []
+    for m in metadatas:
+        for key in m:
+            if key not in fields:
+                fields.append(key)
+
+    values = {field: [] for field in fields}
+    lookup = {field: {} for field in fields}
+    codes = np.full((len(metadatas), len(fields)), _MISSING, dtype=np.int32)
+    for row, m in enumerate(metadatas):
+        for col, field in enumerate(fields):
+            if field not in m:
+                continue
+            v = m[field]
+            # json round-trip keeps the values comparable to what we load back
+            key = json.dumps(v, sort_keys=True, ensure_ascii=False)
+            if key not in lookup[field]:
+                lookup[field][key] = len(values[field])
+                values[field].append(v)
+            codes[row, col] = lookup[field][key]
+
+    with atomic_write(os.path.join(index_dir, META_FILE), "w", encoding="utf-8") as f:
+        json.dump({"fields": fields, "values": values}, f, ensure_ascii=False)
+    with atomic_write(os.path.join(index_dir, CODES_FILE)) as f:
+        np.save(f, codes)
+
+
+def convert_pickle(index_dir):
+    """
+    One-shot conversion of an existing metadatas.pkl into the columnar store.
+    """
+    with open(os.path.join(index_dir, "metadatas.pkl"), "rb") as f:
+        meta = pickle.load(f)
+    write_text_store(index_dir, meta["texts"], meta["metadatas"])
+    print(f"[TextStore] Converted {len(meta['texts'])} rows in {index_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert metadatas.pkl to the columnar text store")
+    parser.add_argument("index_dir", nargs="?", default=INDEX_DIR)
+    args = parser.parse_args()
+    convert_pickle(args.index_dir)
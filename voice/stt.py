@@ -1,7 +1,14 @@
-import whisper
+from startup import Lazy
 
-_model = whisper.load_model("tiny")
+
+def _load_model():
+    import whisper
+
+    return whisper.load_model("tiny")
+
+# loaded on first transcription (or by the app's warm-up thread)
+model = Lazy("whisper", _load_model)
 
 def speech_to_text(audio_path: str) -> str:
-    result = _model.transcribe(audio_path)
+    result = model.transcribe(audio_path)
     return result.get("text", "").strip()
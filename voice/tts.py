@@ -1,4 +1,5 @@
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import edge_tts
 
 VOICE = "en-US-JennyNeural"  # صوت هادي وداعم
@@ -14,5 +15,22 @@ def text_to_speech(text: str, out_path: str = "response.mp3") -> str:
     if not text.strip():
         return None
 
-    asyncio.run(_generate_speech(text, out_path))
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        asyncio.run(_generate_speech(text, out_path))
+    else:
+        # asyncio.run() cannot nest inside a running loop; use a fresh one on a worker thread
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            pool.submit(asyncio.run, _generate_speech(text, out_path)).result()
+    return out_path
+
+async def atext_to_speech(text: str, out_path: str = "response.mp3") -> str:
+    """
+    Awaitable text_to_speech for callers already inside an event loop.
+    """
+    if not text.strip():
+        return None
+
+    await _generate_speech(text, out_path)
     return out_path